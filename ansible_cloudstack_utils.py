@@ -1,5 +1,11 @@
 class AnsibleCloudStack:
 
+    # Resources which may be cached on disk across module runs
+    cache_resources = [ 'zones', 'domains', 'os_types', 'hypervisors', 'capabilities' ]
+
+    # Format of the cache entries, entries of another marshal or python version are dropped
+    cache_format = (1, marshal.version, tuple(sys.version_info[:2]))
+
     def __init__(self, module):
         if not has_lib_cs:
             module.fail_json(msg="python library cs required: pip install cs")
@@ -10,6 +16,7 @@ class AnsibleCloudStack:
 
         self.module = module
         self._connect()
+        self._invalidate_cache()
 
         self.domain = None
         self.account = None
@@ -17,6 +24,7 @@ class AnsibleCloudStack:
         self.ip_address = None
         self.zone = None
         self.vm = None
+        self.vm_args = None
         self.os_type = None
         self.hypervisor = None
         self.capabilities = None
@@ -30,15 +38,185 @@ class AnsibleCloudStack:
         api_timeout = self.module.params.get('api_timeout')
 
         if api_key and api_secret and api_url:
-            self.cs = CloudStack(
-                endpoint=api_url,
-                key=api_key,
-                secret=api_secret,
-                timeout=api_timeout,
-                method=api_http_method
-                )
+            self.api_config = {
+                'endpoint': api_url,
+                'key':      api_key,
+                'secret':   api_secret,
+                'timeout':  api_timeout,
+                'method':   api_http_method,
+            }
         else:
-            self.cs = CloudStack(**read_config())
+            self.api_config = read_config()
+
+        session = self._get_session()
+        try:
+            self.cs = CloudStack(session=session, **self.api_config)
+        except TypeError:
+            # cs < 2.7 takes no session and opens a connection per call
+            self.cs = CloudStack(**self.api_config)
+
+        if self.module.params.get('api_stats'):
+            self.cs = AnsibleCloudStackApiStats(self.cs, session)
+            self.result['api_stats'] = self.cs.stats
+
+
+    def _get_session(self):
+        # Connections (incl. their TLS handshake) are kept alive and reused by all API calls
+        pool_size = self.module.params.get('api_pool_size') or 1
+        adapter = AnsibleCloudStackAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session = AnsibleCloudStackSession()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    def _get_cache_file(self, resource):
+        cache_dir = self.module.params.get('api_cache_dir') or os.environ.get('CLOUDSTACK_CACHE_DIR')
+        if not cache_dir:
+            return None
+
+        # Scope the cache by endpoint and account (api key), results may differ per account
+        scope = "%s %s" % (self.api_config.get('endpoint'), self.api_config.get('key'))
+        cache_dir = os.path.join(os.path.expanduser(cache_dir), hashlib.sha1(scope).hexdigest())
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError:
+                # Another fork may have created it in the meantime
+                if not os.path.isdir(cache_dir):
+                    self.module.fail_json(msg="Could not create cache dir '%s'" % cache_dir)
+        return os.path.join(cache_dir, "%s.cache" % resource)
+
+
+    def _read_cache(self, cache_file):
+        try:
+            f = open(cache_file, 'rb')
+            try:
+                entry = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if not isinstance(entry, dict) or entry.get('format') != self.cache_format:
+            return None
+        if time.time() - entry.get('created', 0) > self.module.params.get('api_cache_ttl'):
+            return None
+        return entry.get('data')
+
+
+    def _write_cache(self, cache_file, data):
+        # Write to a temp file and rename it, readers never see a partial file
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix='.%s.' % os.path.basename(cache_file))
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump({ 'format': self.cache_format, 'created': time.time(), 'data': data }, f)
+            finally:
+                f.close()
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError, ValueError):
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+
+    def _invalidate_cache(self):
+        resources = self.module.params.get('api_cache_invalidate')
+        if not resources:
+            return
+        if 'all' in resources:
+            resources = self.cache_resources
+
+        for resource in resources:
+            if resource not in self.cache_resources:
+                self.module.fail_json(msg="Unknown cache resource '%s', choose from: %s" % (resource, ', '.join(self.cache_resources)))
+            cache_file = self._get_cache_file(resource)
+            if cache_file and os.path.exists(cache_file):
+                os.unlink(cache_file)
+
+
+    def query_cached(self, resource, command, **args):
+        cache_file = self._get_cache_file(resource)
+        if not cache_file:
+            return getattr(self.cs, command)(**args)
+
+        data = self._read_cache(cache_file)
+        if data is not None:
+            return data
+
+        # Serialize refreshs, only one fork queries the API, others wait and read its result
+        lock = open(cache_file + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._read_cache(cache_file)
+            if data is None:
+                data = getattr(self.cs, command)(**args)
+                if data and 'errortext' not in data:
+                    self._write_cache(cache_file, data)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        return data
+
+
+    def iter_list(self, command, result_key, **args):
+        # Walk the listing page by page and yield the records one by one,
+        # callers looking for a single match can stop early.
+        pagesize = self.module.params.get('api_page_size') or 500
+        page = 1
+        seen = 0
+        while True:
+            args['page'] = page
+            args['pagesize'] = pagesize
+            res = getattr(self.cs, command)(**args)
+            if not res or result_key not in res:
+                return
+
+            records = res[result_key]
+            for r in records:
+                yield r
+            seen += len(records)
+
+            if len(records) < pagesize or seen >= res.get('count', seen + 1):
+                return
+            page += 1
+
+
+    def query_by_name(self, command, result_key, name, match_keys, ignore_case=False, **args):
+        # Let the API filter by id or keyword first and only fall back to a
+        # full listing if the filtered query did not return anything.
+        lookups = [ 'keyword', None ]
+        if re.match(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', name.lower()):
+            lookups.insert(0, 'id')
+
+        if ignore_case:
+            name = name.lower()
+
+        for lookup in lookups:
+            query_args = args.copy()
+            if lookup:
+                query_args[lookup] = name
+
+            has_results = False
+            try:
+                for r in self.iter_list(command, result_key, **query_args):
+                    has_results = True
+                    values = [ r.get(k) for k in match_keys ]
+                    if ignore_case:
+                        values = [ v.lower() for v in values if v ]
+                    if name in values:
+                        self.module.log("%s: found '%s' by %s" % (command, name, lookup or 'full listing'))
+                        return r
+            except CloudStackException, e:
+                # CloudStack rejects an id of no existing resource (error 431), the name merely looks like a UUID
+                if lookup != 'id' or getattr(getattr(e, 'response', None), 'status_code', None) != 431:
+                    raise
+
+            # The filtered listing is conclusive if it returned anything at all
+            if has_results:
+                break
+        self.module.log("%s: '%s' not found, last lookup by %s" % (command, name, lookup or 'full listing'))
+        return None
 
 
     def get_or_fallback(self, key=None, fallback_key=None):
@@ -96,12 +274,10 @@ class AnsibleCloudStack:
         args = {}
         args['account'] = self.get_account(key='name')
         args['domainid'] = self.get_domain(key='id')
-        projects = self.cs.listProjects(**args)
-        if projects:
-            for p in projects['project']:
-                if project.lower() in [ p['name'].lower(), p['id'] ]:
-                    self.project = p
-                    return self._get_by_key(key, self.project)
+        p = self.query_by_name('listProjects', 'project', project, [ 'name', 'id' ], ignore_case=True, **args)
+        if p:
+            self.project = p
+            return self._get_by_key(key, self.project)
         self.module.fail_json(msg="project '%s' not found" % project)
 
 
@@ -128,25 +304,27 @@ class AnsibleCloudStack:
 
 
     def get_vm(self, key=None):
-        if self.vm:
-            return self._get_by_key(key, self.vm)
-
-        vm = self.module.params.get('vm')
-        if not vm:
-            self.module.fail_json(msg="Virtual machine param 'vm' is required")
-
-        args = {}
-        args['account'] = self.get_account(key='name')
-        args['domainid'] = self.get_domain(key='id')
-        args['projectid'] = self.get_project(key='id')
-        args['zoneid'] = self.get_zone(key='id')
-        vms = self.cs.listVirtualMachines(**args)
-        if vms:
-            for v in vms['virtualmachine']:
-                if vm in [ v['name'], v['displayname'], v['id'] ]:
-                    self.vm = v
-                    return self._get_by_key(key, self.vm)
-        self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
+        if not self.vm:
+            vm = self.module.params.get('vm')
+            if not vm:
+                self.module.fail_json(msg="Virtual machine param 'vm' is required")
+
+            args = {}
+            args['account'] = self.get_account(key='name')
+            args['domainid'] = self.get_domain(key='id')
+            args['projectid'] = self.get_project(key='id')
+            args['zoneid'] = self.get_zone(key='id')
+            self.vm = self.query_by_name('listVirtualMachines', 'virtualmachine', vm, [ 'name', 'displayname', 'id' ],
+                                         details='min', **args)
+            if not self.vm:
+                self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
+            self.vm_args = args
+
+        # The VM was looked up with minimal details, fetch all once a key outside of them is needed
+        if self.vm_args is not None and (key is None or key not in self.vm):
+            self.vm = self.cs.listVirtualMachines(id=self.vm['id'], **self.vm_args)['virtualmachine'][0]
+            self.vm_args = None
+        return self._get_by_key(key, self.vm)
 
 
     def get_zone(self, key=None):
@@ -154,7 +332,7 @@ class AnsibleCloudStack:
             return self._get_by_key(key, self.zone)
 
         zone = self.module.params.get('zone')
-        zones = self.cs.listZones()
+        zones = self.query_cached('zones', 'listZones')
 
         # use the first zone if no zone param given
         if not zone:
@@ -171,13 +349,13 @@ class AnsibleCloudStack:
 
     def get_os_type(self, key=None):
         if self.os_type:
-            return self._get_by_key(key, self.zone)
+            return self._get_by_key(key, self.os_type)
 
         os_type = self.module.params.get('os_type')
         if not os_type:
             return None
 
-        os_types = self.cs.listOsTypes()
+        os_types = self.query_cached('os_types', 'listOsTypes')
         if os_types:
             for o in os_types['ostype']:
                 if os_type in [ o['description'], o['id'] ]:
@@ -191,7 +369,7 @@ class AnsibleCloudStack:
             return self.hypervisor
 
         hypervisor = self.module.params.get('hypervisor')
-        hypervisors = self.cs.listHypervisors()
+        hypervisors = self.query_cached('hypervisors', 'listHypervisors')
 
         # use the first hypervisor if no hypervisor param given
         if not hypervisor:
@@ -238,7 +416,7 @@ class AnsibleCloudStack:
 
         args = {}
         args['listall'] = True
-        domains = self.cs.listDomains(**args)
+        domains = self.query_cached('domains', 'listDomains', **args)
         if domains:
             for d in domains['domain']:
                 if d['path'].lower() in [ domain.lower(), "root/" + domain.lower(), "root" + domain.lower() ] :
@@ -255,40 +433,38 @@ class AnsibleCloudStack:
 
 
     def _delete_tags(self, resource, resource_type, tags):
-        existing_tags = resource['tags']
-        tags_to_delete = []
-        for existing_tag in existing_tags:
-            if existing_tag['key'] in tags:
-                if existing_tag['value'] != tags[key]:
-                    tags_to_delete.append(existing_tag)
-            else:
-                tags_to_delete.append(existing_tag)
-        if tags_to_delete:
+        if tags:
             self.result['changed'] = True
             if not self.module.check_mode:
                 args = {}
                 args['resourceids']  = resource['id']
                 args['resourcetype'] = resource_type
-                args['tags']         = tags_to_delete
-                self.cs.deleteTags(**args)
+                args['tags']         = tags
+                return self.cs.deleteTags(**args)
+        return None
 
 
     def _create_tags(self, resource, resource_type, tags):
-        tags_to_create = []
-        for i, tag_entry in enumerate(tags):
-            tag = {
-                'key':   tag_entry['key'],
-                'value': tag_entry['value'],
-            }
-            tags_to_create.append(tag)
-        if tags_to_create:
+        if tags:
             self.result['changed'] = True
             if not self.module.check_mode:
                 args = {}
                 args['resourceids']  = resource['id']
                 args['resourcetype'] = resource_type
-                args['tags']         = tags_to_create
-                self.cs.createTags(**args)
+                args['tags']         = tags
+                return self.cs.createTags(**args)
+        return None
+
+
+    def _get_tags_dict(self, tags):
+        tags_dict = {}
+        for tag in tags:
+            value = tag['value']
+            # API returns strings, make sure e.g. ints from YAML compare equal
+            if not isinstance(value, basestring):
+                value = str(value)
+            tags_dict[tag['key']] = value
+        return tags_dict
 
 
     def ensure_tags(self, resource, resource_type=None):
@@ -298,16 +474,53 @@ class AnsibleCloudStack:
         if 'tags' in resource:
             tags = self.module.params.get('tags')
             if tags is not None:
-                self._delete_tags(resource, resource_type, tags)
-                self._create_tags(resource, resource_type, tags)
-                resource['tags'] = self.get_tags(resource)
+                wanted = self._get_tags_dict(tags)
+                existing = self._get_tags_dict(resource['tags'])
+
+                # Tags removed or having a different value are deleted,
+                # tags new or having a different value are created.
+                tags_to_delete = []
+                for tag in resource['tags']:
+                    if wanted.get(tag['key']) != existing[tag['key']]:
+                        tags_to_delete.append({ 'key': tag['key'], 'value': tag['value'] })
+
+                tags_to_create = []
+                for tag in tags:
+                    value = wanted[tag['key']]
+                    if existing.get(tag['key']) != value and { 'key': tag['key'], 'value': value } not in tags_to_create:
+                        tags_to_create.append({ 'key': tag['key'], 'value': value })
+
+                jobs = []
+                res = self._delete_tags(resource, resource_type, tags_to_delete)
+                if res:
+                    # A tag with a changed value has to be deleted before it can be created again
+                    if set(existing.keys()) & set([ t['key'] for t in tags_to_create ]):
+                        self.poll_job(res)
+                    else:
+                        jobs.append(res)
+
+                res = self._create_tags(resource, resource_type, tags_to_create)
+                if res:
+                    jobs.append(res)
+
+                if self.module.params.get('poll_async'):
+                    self.poll_jobs(jobs)
+
+                # Build the resulting tags locally instead of listing them again
+                resource_tags = []
+                for tag in resource['tags']:
+                    if wanted.get(tag['key']) == existing[tag['key']]:
+                        resource_tags.append(tag)
+                for tag in tags_to_create:
+                    resource_tags.append(tag)
+                resource['tags'] = resource_tags
         return resource
 
 
     def get_capabilities(self, key=None):
         if self.capabilities:
             return self._get_by_key(key, self.capabilities)
-        capabilities = self.cs.listCapabilities()
+        capabilities = self.query_cached('capabilities', 'listCapabilities')
         self.capabilities = capabilities['capability']
         return self._get_by_key(key, self.capabilities)
 
@@ -317,15 +530,216 @@ class AnsibleCloudStack:
         return self.poll_job(job=job, key=key)
 
 
+    def get_poll_delays(self):
+        # Short first delay, then exponential backoff with jitter up to poll_max_interval
+        # Not typed as float in the argument_spec, Ansible 2.0 rejects ints (e.g. poll_backoff: 2) for floats
+        try:
+            interval = float(self.module.params.get('poll_interval') or 0) or 0.5
+            max_interval = float(self.module.params.get('poll_max_interval') or 0) or 10.0
+            backoff = float(self.module.params.get('poll_backoff') or 0) or 2.0
+        except (TypeError, ValueError):
+            self.module.fail_json(msg="poll_interval, poll_max_interval and poll_backoff must be numbers")
+        while True:
+            delay = min(interval, max_interval)
+            yield random.uniform(delay * 0.75, delay)
+            interval = interval * backoff
+
+
+    def _update_poll_stats(self, polls, started):
+        self.result['poll_count'] = self.result.get('poll_count', 0) + polls
+        self.result['poll_time'] = round(self.result.get('poll_time', 0) + time.time() - started, 3)
+
+
+    def _record_poll_time(self, jobid, started):
+        if isinstance(self.cs, AnsibleCloudStackApiStats):
+            self.cs.record_poll_time(jobid, time.time() - started)
+
+
     def poll_job(self, job=None, key=None):
         if 'jobid' in job:
-            while True:
+            timeout = self.module.params.get('poll_timeout')
+            started = time.time()
+            polls = 0
+            for delay in self.get_poll_delays():
                 res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
+                polls += 1
                 if res['jobstatus'] != 0 and 'jobresult' in res:
+                    self._update_poll_stats(polls, started)
+                    self._record_poll_time(job['jobid'], started)
                     if 'errortext' in res['jobresult']:
                         self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
                     if key and key in res['jobresult']:
                         job = res['jobresult'][key]
                     break
-                time.sleep(2)
+
+                if timeout:
+                    # Sleep until the deadline at most, fail if the job was still pending when polled at the deadline
+                    remaining = timeout - (time.time() - started)
+                    if remaining <= 0:
+                        self._update_poll_stats(polls, started)
+                        self.module.fail_json(msg="Timeout after %ss waiting for async job '%s'" % (timeout, job['jobid']))
+                    delay = min(delay, remaining)
+                time.sleep(delay)
         return job
+
+
+    def _list_jobs(self, jobids, last_page=None, **args):
+        # CloudStack lists async jobs oldest first, the jobs just started are on
+        # the last pages: walk back from the last page and stop once all jobids are seen.
+        pagesize = self.module.params.get('api_page_size') or 500
+        listed = {}
+        calls = 0
+        visited = set()
+        page = last_page or 1
+        while page >= 1 and page not in visited:
+            visited.add(page)
+            args['page'] = page
+            args['pagesize'] = pagesize
+            res = self.cs.listAsyncJobs(**args) or {}
+            calls += 1
+            for job in res.get('asyncjobs', []):
+                if job['jobid'] in jobids:
+                    listed[job['jobid']] = job
+            if len(listed) == len(jobids):
+                break
+            last_page = max(1, (res.get('count', 0) + pagesize - 1) // pagesize)
+            if page > last_page or page == 1:
+                page = last_page
+            else:
+                page -= 1
+        return listed, last_page, calls
+
+
+    def poll_jobs(self, jobs=None, key=None):
+        # Wait for several async jobs at once: each tick refreshes all pending jobs
+        # and resolves the finished ones. A single job is queried, several are
+        # looked up in the listing of the caller's recent jobs.
+        results = list(jobs)
+        pending = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                pending[job['jobid']] = i
+        if not pending:
+            return results
+
+        timeout = self.module.params.get('poll_timeout')
+        started = time.time()
+        polls = 0
+        last_page = None
+
+        # Limit the listing to recent jobs, the date filter has a precision of days
+        args = {}
+        args['startdate'] = time.strftime('%Y-%m-%d', time.gmtime(started - 86400))
+
+        for delay in self.get_poll_delays():
+            listed = {}
+            if len(pending) > 1:
+                listed, last_page, calls = self._list_jobs(pending, last_page, **args)
+                polls += calls
+
+            for jobid in pending.keys():
+                # Jobs not visible in the listing are queried one by one
+                res = listed.get(jobid)
+                if not res:
+                    res = self.cs.queryAsyncJobResult(jobid=jobid)
+                    polls += 1
+
+                if res['jobstatus'] != 0 and 'jobresult' in res:
+                    self._record_poll_time(jobid, started)
+                    index = pending.pop(jobid)
+                    if 'errortext' in res['jobresult']:
+                        self._update_poll_stats(polls, started)
+                        self.module.fail_json(msg="Failed: '%s' (async job '%s', still pending: '%s')" % (
+                                              res['jobresult']['errortext'], jobid, "', '".join(pending.keys())))
+                    if key and key in res['jobresult']:
+                        results[index] = res['jobresult'][key]
+
+            if not pending:
+                break
+
+            if timeout:
+                # Sleep until the deadline at most, fail if jobs were still pending when polled at the deadline
+                remaining = timeout - (time.time() - started)
+                if remaining <= 0:
+                    self._update_poll_stats(polls, started)
+                    self.module.fail_json(msg="Timeout after %ss waiting for async jobs '%s'" % (timeout, "', '".join(pending.keys())))
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+        self._update_poll_stats(polls, started)
+        return results
+
+
+class AnsibleCloudStackApiStats(object):
+    # Wraps the cs client and records calls, wall time, response bytes and
+    # async poll time per API command.
+
+    poll_commands = [ 'queryAsyncJobResult', 'listAsyncJobs' ]
+
+    def __init__(self, cs, session):
+        self.cs = cs
+        self.stats = {}
+        self.jobs = {}
+        # cs sends prepared requests, the hooks of the session are not called,
+        # the bytes are counted by the adapter mounted for both schemes instead.
+        self.adapter = session.get_adapter('https://')
+
+
+    def _get_stats(self, command):
+        if command not in self.stats:
+            self.stats[command] = {
+                'calls':     0,
+                'time':      0.0,
+                'bytes':     0,
+                'poll_time': 0.0,
+            }
+        return self.stats[command]
+
+
+    def record_poll_time(self, jobid, poll_time):
+        # Account the time waited for a job to the command which started it
+        command = self.jobs.get(jobid)
+        if command:
+            stats = self._get_stats(command)
+            stats['poll_time'] = round(stats['poll_time'] + poll_time, 3)
+
+
+    def __getattr__(self, command):
+        handler = getattr(self.cs, command)
+
+        def instrumented(**args):
+            response_bytes = self.adapter.response_bytes
+            started = time.time()
+            try:
+                res = handler(**args)
+            finally:
+                stats = self._get_stats(command)
+                stats['calls'] += 1
+                stats['time'] = round(stats['time'] + time.time() - started, 3)
+                stats['bytes'] += self.adapter.response_bytes - response_bytes
+            # Polling responses carry the jobid too, keep the command which started the job
+            if isinstance(res, dict) and 'jobid' in res and command not in self.poll_commands:
+                self.jobs.setdefault(res['jobid'], command)
+            return res
+        return instrumented
+
+
+if has_lib_cs:
+
+    class AnsibleCloudStackSession(requests.Session):
+        # cs closes its session after every call ("with self.session as session"),
+        # which drops the pooled connections. Keep them open until the module exits.
+
+        def close(self):
+            pass
+
+
+    class AnsibleCloudStackAdapter(requests.adapters.HTTPAdapter):
+        # Counts the bytes of all responses received
+
+        response_bytes = 0
+
+        def send(self, request, **kwargs):
+            response = requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+            self.response_bytes += len(response.content)
+            return response
@@ -57,51 +57,164 @@ based on the data obtained from CloudStack API:
 }
 
 
-usage: cloudstack-routers.py [--list] [--host HOST]
+With --compact the JSON is printed without indentation, group by group and
+host by host, and encoded by ujson if it is installed.
+
+
+usage: cloudstack-routers.py [--list] [--host HOST] [--compact]
 """
 
 import os
 import sys
 import argparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 try:
     import json
 except:
     import simplejson as json
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 try:
     from cs import CloudStack, CloudStackException, read_config
+    import requests
 except ImportError:
     print >> sys.stderr, "Error: CloudStack library must be installed: pip install cs."
     sys.exit(1)
 
 
+class CloudStackSession(requests.Session):
+    """Keep-alive session whose pooled connections outlive a single API call.
+
+    cs closes its session after every call ("with self.session as session"),
+    which would drop the pooled connections.
+    """
+
+    def close(self):
+        pass
+
+
 class CloudStackInventory(object):
+
+    # Number of records fetched per API request
+    page_size = 500
+
+    # Number of pooled keep-alive connections to the API
+    pool_size = 4
+
     def __init__(self):
 
         parser = argparse.ArgumentParser()
         parser.add_argument('--host')
         parser.add_argument('--list', action='store_true')
+        parser.add_argument('--compact', action='store_true', help='print compact JSON')
 
         options = parser.parse_args()
+        self.compact = options.compact
         try:
-            self.cs = CloudStack(**read_config())
+            session = self._get_session()
+            try:
+                self.cs = CloudStack(session=session, **read_config())
+            except TypeError:
+                # cs < 2.7 takes no session and opens a connection per call
+                self.cs = CloudStack(**read_config())
         except CloudStackException, e:
             print >> sys.stderr, "Error: Could not connect to CloudStack API"
 
         if options.host:
             data = self.get_host(options.host)
-            print json.dumps(data, indent=2)
+            self.print_json(data)
 
         elif options.list:
             data = self.get_list()
-            print json.dumps(data, indent=2)
+            self.print_json(data)
         else:
             print >> sys.stderr, "usage: --list | --host <hostname>"
             sys.exit(1)
 
 
+    def _get_session(self):
+        """Return a keep-alive session shared by all API calls."""
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session = CloudStackSession()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    def json_dumps(self, data):
+        """Return compact JSON, encoded by ujson if it is installed."""
+        if ujson:
+            return ujson.dumps(data)
+        return json.dumps(data, separators=(',', ':'))
+
+
+    def print_json(self, data):
+        """Print the inventory, compact output is written group by group and host by host."""
+        if not self.compact:
+            print json.dumps(data, indent=2)
+            return
+        if '_meta' not in data:
+            print self.json_dumps(data)
+            return
+
+        out = sys.stdout
+        out.write('{')
+        for group_name, group in data.iteritems():
+            if group_name != '_meta':
+                out.write('%s:%s,' % (self.json_dumps(group_name), self.json_dumps(group)))
+        out.write('"_meta":{"hostvars":{')
+        separator = ''
+        for host_name, hostvars in data['_meta']['hostvars'].iteritems():
+            out.write('%s%s:%s' % (separator, self.json_dumps(host_name), self.json_dumps(hostvars)))
+            separator = ','
+        out.write('}}}\n')
+
+
+    def iter_list(self, command, result_key, **args):
+        """Yield the records of a listing, page by page."""
+        page = 1
+        seen = 0
+        while True:
+            args['page'] = page
+            args['pagesize'] = self.page_size
+            res = getattr(self.cs, command)(**args)
+            if not res or result_key not in res:
+                return
+
+            records = res[result_key]
+            for record in records:
+                yield record
+            seen += len(records)
+
+            if len(records) < self.page_size or seen >= res.get('count', seen + 1):
+                return
+            page += 1
+
+
+    def get_routers(self, **args):
+        """Fetch the routers of all projects and of the account scope concurrently, de-duplicated by id."""
+        scopes = [ dict(args, projectid=-1, listall=True), dict(args, listall=True) ]
+        pool = ThreadPool(len(scopes))
+        try:
+            results = pool.map(lambda scope: list(self.iter_list('listRouters', 'router', **scope)), scopes)
+        finally:
+            pool.close()
+            pool.join()
+
+        routers = OrderedDict()
+        for result in results:
+            for router in result:
+                routers[router['id']] = router
+        return routers.values()
+
+
     def add_group(self, data, group_name, router_name):
         if group_name not in data:
             data[group_name] = {
@@ -112,18 +225,8 @@ class CloudStackInventory(object):
 
 
     def get_host(self, name):
-        routers = []
-
-        routers_projects = self.cs.listRouters(projectid=-1, listall=True)
-        if routers_projects and 'router' in routers_projects:
-            routers = routers + routers_projects['router']
-
-        routers_accounts = self.cs.listRouters(listall=True)
-        if routers_accounts and 'router' in routers_accounts:
-            routers = routers + routers_accounts['router']
-
         data = {}
-        for router in routers:
+        for router in self.get_routers():
             router_name = router['name']
             if name == router_name:
                 data['zone'] = router['zonename']
@@ -160,17 +263,7 @@ class CloudStackInventory(object):
                 },
             }
 
-        routers = []
-
-        routers_projects = self.cs.listRouters(projectid=-1, listall=True)
-        if routers_projects and 'router' in routers_projects:
-            routers = routers + routers_projects['router']
-
-        routers_accounts = self.cs.listRouters(listall=True)
-        if routers_accounts and 'router' in routers_accounts:
-            routers = routers + routers_accounts['router']
-
-        for router in routers:
+        for router in self.get_routers(state='Running'):
             if router['state'] != 'Running':
                 continue
             router_name = router['name']
@@ -31,6 +31,10 @@ script, e.g. project_cloudstack.sh:
   #!/bin/bash
   cloudstack.py --project <your_project> $@
 
+Several projects can be passed as --project web,db or by repeating --project,
+--all-projects collects the account scope and every project. The scopes are
+fetched concurrently and each project becomes a group.
+
 
 When run against a specific host, this script returns the following attributes
 based on the data obtained from CloudStack API:
@@ -67,106 +71,852 @@ based on the data obtained from CloudStack API:
   }
 
 
-usage: cloudstack.py [--list] [--host HOST] [--project PROJECT]
+The generated inventory is cached, settings are read from the section
+[cloudstack_inventory] of 'cloudstack.ini':
+
+  [cloudstack_inventory]
+  # Directory of the cache files
+  cache_path = ~/.ansible/tmp
+  # Seconds a cached inventory is used, 0 disables the cache
+  cache_max_age = 300
+  # Seconds between full rebuilds, 0 disables incremental refreshes
+  full_refresh_interval = 3600
+  # Seconds events are looked back before the last seen event
+  events_overlap = 300
+  # Comma separated sections with endpoint, key and secret of several regions
+  regions =
+  # Filters of the VMs passed to the API: zone name or id, VM state (e.g. Running),
+  # comma separated tags key=value and a keyword
+  zone =
+  state =
+  tags =
+  keyword =
+  # Detail groups of the VMs listed, 'all' for every detail
+  details = group,nics,secgrp,servoff,affgrp,stats
+  # Groups made besides instance groups and projects
+  group_by = tags,zone,service_offering,network
+  # Print compact JSON instead of indented
+  compact = no
+  # Seconds an expired cache is still served while it is refreshed in the
+  # background, 0 refreshes it before printing
+  max_stale = 0
+  # Seconds between refreshes of --refresh-daemon, default cache_max_age / 2
+  refresh_interval =
+
+An expired cache is refreshed incrementally: VMs with lifecycle or tag events
+(listEvents) since the last refresh are fetched again by id, a full rebuild
+runs every full_refresh_interval. Use --refresh-cache to rebuild the cache from
+the API. Along with the cache, the hostvars are stored in an SQLite index keyed
+by host name, --host is answered from this index and only queries the API for
+hosts not found in it.
+
+The cache and the index are stored by marshal in a versioned format. The cache
+file is memory-mapped and split in sections (groups, hostvars and the refresh
+state), only the sections needed are loaded. Files of another format or python
+version are dropped and rebuilt.
+
+With regions set, the regions are queried concurrently and merged into one
+inventory, each region becomes a group and the hostvar 'region'. A region that
+fails, e.g. by a timeout, is served from its expired cache if there is one.
+A host with a name already taken by a previous region is renamed to
+<region>_<name>, with a warning.
+
+The filters can be passed by --zone, --state, --tag key=value and --keyword as
+well and limit the VMs listed by the API. Only the detail groups of the VMs
+used by the hostvars are listed, hostvars of groups left out of details are
+not set. --host finds the host with minimal details and then fetches only
+this host with the configured details.
+
+Besides instance groups and projects, the hosts are grouped by tag (tag_<key>
+and tag_<key>_<value>), zone (zone_<zone>), service offering
+(service_offering_<offering>) and attached networks (network_<network>).
+
+With --compact (or compact = yes) the JSON is printed without indentation,
+group by group and host by host, and encoded by ujson if it is installed.
+
+--refresh refreshes the cache without printing it, --refresh-daemon keeps
+refreshing it every refresh_interval seconds, e.g. run by systemd or cron
+@reboot, so --list finds a warm cache. Both need the cache (cache_max_age > 0),
+the daemon reports a failed refresh and retries it. With max_stale, --list
+prints an expired cache immediately and starts a --refresh in the background.
+
+
+usage: cloudstack.py [--list] [--host HOST] [--project PROJECT] [--all-projects]
+                     [--zone ZONE] [--state STATE] [--tag KEY=VALUE]
+                     [--keyword KEYWORD] [--refresh-cache] [--compact]
+                     [--refresh] [--refresh-daemon]
 """
 
 import os
+import re
 import sys
+import copy
+import time
+import mmap
+import calendar
+import fcntl
+import struct
+import marshal
+import sqlite3
+import hashlib
 import argparse
+import tempfile
+import subprocess
+import ConfigParser
+from multiprocessing.pool import ThreadPool
 
 try:
     import json
 except:
     import simplejson as json
 
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
 
 try:
     from cs import CloudStack, CloudStackException, read_config
+    import requests
 except ImportError:
     print >> sys.stderr, "Error: CloudStack library must be installed: pip install cs."
     sys.exit(1)
 
 
+class CloudStackSession(requests.Session):
+    """Keep-alive session whose pooled connections outlive a single API call.
+
+    cs closes its session after every call ("with self.session as session"),
+    which would drop the pooled connections.
+    """
+
+    def close(self):
+        pass
+
+
+class CloudStackInventoryError(Exception):
+    """Error ending the script, raised in worker threads as well and reported by the main thread."""
+    pass
+
+
 class CloudStackInventory(object):
+
+    # Number of records fetched per API request
+    page_size = 500
+
+    # Number of pooled keep-alive connections to the API
+    pool_size = 4
+
+    # Defaults of the [cloudstack_inventory] section in cloudstack.ini
+    settings = {
+        'cache_path': '~/.ansible/tmp',
+        'cache_max_age': '300',
+        'full_refresh_interval': '3600',
+        'events_overlap': '300',
+        'regions': '',
+        'zone': '',
+        'state': '',
+        'tags': '',
+        'keyword': '',
+        'details': 'group,nics,secgrp,servoff,affgrp,stats',
+        'group_by': 'tags,zone,service_offering,network',
+        'compact': 'no',
+        'max_stale': '0',
+        'refresh_interval': '',
+    }
+
+    # Number of VM ids per listVirtualMachines request of an incremental refresh
+    ids_per_request = 100
+
+    # Events of tags, the type of the tagged resource tells whether a VM changed
+    tag_events = [ 'CREATE_TAGS', 'DELETE_TAGS' ]
+
+    # Version of the cache layout, bump it on incompatible changes. Caches of
+    # another version, marshal format or python version are dropped.
+    cache_version = 1
+    cache_format = '%d-%d-%d.%d' % (cache_version, marshal.version, sys.version_info[0], sys.version_info[1])
+
     def __init__(self):
 
         parser = argparse.ArgumentParser()
         parser.add_argument('--host')
         parser.add_argument('--list', action='store_true')
-        parser.add_argument('--project')
+        parser.add_argument('--project', action='append', default=[],
+                            help='project name or id, comma separated or repeated for several projects')
+        parser.add_argument('--all-projects', action='store_true',
+                            help='collect the account scope and every project')
+        parser.add_argument('--zone', help='list VMs of this zone only')
+        parser.add_argument('--state', help='list VMs in this state only, e.g. Running')
+        parser.add_argument('--tag', action='append', default=[],
+                            help='list VMs having this tag only, key=value, may be repeated')
+        parser.add_argument('--keyword', help='list VMs matching this keyword only')
+        parser.add_argument('--refresh-cache', action='store_true',
+                            help='ignore the cached inventory and rebuild it from the API')
+        parser.add_argument('--compact', action='store_true', help='print compact JSON')
+        parser.add_argument('--refresh', action='store_true',
+                            help='refresh the cache without printing the inventory')
+        parser.add_argument('--refresh-daemon', action='store_true',
+                            help='keep refreshing the cache every refresh_interval seconds')
 
         options = parser.parse_args()
-        try:
-            self.cs = CloudStack(**read_config())
-        except CloudStackException, e:
-            print >> sys.stderr, "Error: Could not connect to CloudStack API"
+        self.read_settings()
+        self.zone = options.zone or self.settings['zone']
+        self.vm_state = options.state or self.settings['state']
+        self.keyword = options.keyword or self.settings['keyword']
+        self.details = self.settings['details'].replace(' ', '')
+        self.group_by = [ g.strip() for g in self.settings['group_by'].split(',') if g.strip() ]
+        self.compact = options.compact or self.settings['compact'].lower() in [ 'yes', 'true', 'on', '1' ]
+        self.max_stale = int(self.settings['max_stale'])
+        self.refresh_interval = int(self.settings['refresh_interval'] or max(1, self.cache_max_age / 2))
+        self.tags = []
+        for tag in options.tag or self.settings['tags'].split(','):
+            if tag.strip():
+                key, sep, value = tag.strip().partition('=')
+                self.tags.append({ 'key': key, 'value': value })
+
+        self.options = options
+        self.projects = [ p for project in options.project for p in project.split(',') if p ]
+        if options.all_projects:
+            self.projects = [ 'all' ]
 
-        project_id = ''
-        if options.project:
-            project_id = self.get_project_id(options.project)
+        self.region = None
+        if self.regions:
+            regions = [ self.get_region(region) for region in self.regions ]
+        else:
+            self.connect(read_config())
+            regions = [ self ]
 
         if options.host:
-            data = self.get_host(options.host)
-            print json.dumps(data, indent=2)
+            if len(regions) == 1:
+                data = regions[0].find_host(options.host)
+            else:
+                data = {}
+                for host in self.map_regions(lambda region: region.find_merged_host(options.host), regions):
+                    if host:
+                        data = host
+                        break
+            self.print_json(data)
 
         elif options.list:
-            data = self.get_list()
-            print json.dumps(data, indent=2)
+            if len(regions) == 1:
+                data = regions[0].get_inventory()
+            else:
+                data = self.merge_regions(self.map_regions(lambda region: region.get_inventory(), regions))
+            self.print_json(data)
+            if [ region for region in regions if region.stale ]:
+                self.revalidate()
+
+        elif options.refresh or options.refresh_daemon:
+            # Without a cache every refresh would query the API for nothing
+            if self.cache_max_age <= 0:
+                raise CloudStackInventoryError("--refresh and --refresh-daemon need the cache, cache_max_age is 0.")
+            while True:
+                started = time.time()
+                try:
+                    self.map_regions(lambda region: region.get_inventory(), regions)
+                except Exception, e:
+                    # The daemon outlives any failed refresh, e.g. of an unwritable cache or an unexpected response
+                    if not options.refresh_daemon:
+                        raise
+                    print >> sys.stderr, "Warning: Refresh failed: %s: %s" % (e.__class__.__name__, e)
+                if not options.refresh_daemon:
+                    break
+                time.sleep(max(0, self.refresh_interval - (time.time() - started)))
         else:
-            print >> sys.stderr, "usage: --list | --host <hostname> [--project <project>]"
+            print >> sys.stderr, "usage: --list | --host <hostname> [--project <project> | --all-projects] [--refresh-cache]"
             sys.exit(1)
 
 
-    def get_project_id(self, project):
-        projects = self.cs.listProjects()
-        if projects:
-            for p in projects['project']:
-                if p['name'] == project or p['id'] == project:
-                    return p['id']
-        print >> sys.stderr, "Error: Project %s not found." % project
-        sys.exit(1)
+    def connect(self, api_config):
+        try:
+            self.api_config = api_config
+            session = self._get_session()
+            try:
+                self.cs = CloudStack(session=session, **self.api_config)
+            except TypeError:
+                # cs < 2.7 takes no session and opens a connection per call
+                self.cs = CloudStack(**self.api_config)
+        except CloudStackException, e:
+            print >> sys.stderr, "Error: Could not connect to CloudStack API"
+
+        self.vm_filters = None
+        self.cache_file = self.get_cache_file('%s|%s|%s|%s|%s|%s|%s' % (','.join(sorted(self.projects)), self.zone,
+                                              self.vm_state, json.dumps(self.tags, sort_keys=True), self.keyword,
+                                              self.details, ','.join(self.group_by)))
+        self.index_file = os.path.splitext(self.cache_file)[0] + '.db'
+        self.state = None
+        self.stale = False
+
+
+    def get_region(self, region):
+        """Return a copy of the inventory connected to the endpoint of a region section."""
+        if not self.config.has_section(region):
+            print >> sys.stderr, "Error: Section %s of region not found in cloudstack.ini." % region
+            sys.exit(1)
+        api_config = {}
+        for key in [ 'endpoint', 'key', 'secret', 'timeout', 'method' ]:
+            if self.config.has_option(region, key):
+                api_config[key] = self.config.get(region, key)
+
+        inventory = copy.copy(self)
+        inventory.region = region
+        inventory.connect(api_config)
+        return inventory
+
+
+    def map_regions(self, func, regions):
+        """Call func for each region concurrently."""
+        pool = ThreadPool(len(regions))
+        try:
+            return pool.map(func, regions)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def merge_regions(self, inventories):
+        data = {
+            'all': {
+                'hosts': [],
+                },
+            '_meta': {
+                'hostvars': {},
+                },
+            }
+        for region, inventory in zip(self.regions, inventories):
+            if not inventory:
+                continue
+
+            # A host name taken by a previous region is prefixed by the region
+            names = {}
+            for host_name in inventory['_meta']['hostvars']:
+                names[host_name] = host_name
+                if host_name in data['_meta']['hostvars']:
+                    names[host_name] = '%s_%s' % (region, host_name)
+            renamed = len([ n for n, new_name in names.iteritems() if n != new_name ])
+            if renamed:
+                print >> sys.stderr, "Warning: %d hosts of region %s renamed to %s_<name>, their names exist in another region." % (
+                                     renamed, region, region)
+
+            for group_name, group in inventory.iteritems():
+                if group_name == '_meta':
+                    continue
+                if group_name not in data:
+                    data[group_name] = {
+                            'hosts': []
+                        }
+                data[group_name]['hosts'].extend([ names.get(n, n) for n in group['hosts'] ])
+
+            # Make a group per region
+            data[region] = {
+                    'hosts': [ names.get(n, n) for n in inventory['all']['hosts'] ]
+                }
+            for host_name, hostvars in inventory['_meta']['hostvars'].iteritems():
+                hostvars['region'] = region
+                data['_meta']['hostvars'][names[host_name]] = hostvars
+        return data
+
+
+    def get_inventory(self):
+        """Return the inventory from the cache, refreshed incrementally or rebuilt from the API."""
+        refresh = self.options.refresh or self.options.refresh_daemon
+        try:
+            data = None
+            if not self.options.refresh_cache and not refresh:
+                data = self.read_cache()
+                if data is None and self.max_stale > 0:
+                    data = self.read_cache(max_age=self.cache_max_age + self.max_stale)
+                    self.stale = data is not None
+            if data is None:
+                # Background refreshes leave the cache to a refresh already running
+                lock = self.lock_refresh(blocking=not refresh)
+                if not lock:
+                    return None
+                try:
+                    # Another process may have refreshed the cache while waiting for the lock
+                    if not self.options.refresh_cache and not refresh:
+                        data = self.read_cache()
+                        if data is not None:
+                            return data
+                    project_ids = self.get_project_ids(self.projects, self.options.all_projects)
+                    # Resolve the filters once, before the scopes are listed concurrently
+                    self.get_vm_filters()
+                    if not self.options.refresh_cache:
+                        data = self.refresh_list(project_ids)
+                    if data is None:
+                        data = self.get_list(project_ids)
+                    self.write_cache(data)
+                finally:
+                    lock.close()
+            return data
+        except (CloudStackException, requests.exceptions.RequestException), e:
+            # One failing region does not fail the inventory of the others
+            if not self.region:
+                raise
+            print >> sys.stderr, "Warning: Region %s failed, serving its expired cache: %s" % (self.region, e)
+            return self.read_cache(expire=False)
+
+
+    def lock_refresh(self, blocking=True):
+        """Return the locked lock file of the cache, None if it is locked by another process."""
+        if self.cache_max_age <= 0:
+            return open(os.devnull)
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            lock = open(os.path.splitext(self.cache_file)[0] + '.lock', 'a')
+        except (IOError, OSError):
+            # Without a writable cache path there is nothing to protect
+            return open(os.devnull)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (not blocking and fcntl.LOCK_NB or 0))
+        except IOError:
+            lock.close()
+            return None
+        return lock
+
+
+    def revalidate(self):
+        """Refresh the cache by a detached process, the stale inventory was printed meanwhile."""
+        sys.stdout.flush()
+        args = [ a for a in sys.argv[1:] if a not in [ '--list', '--compact' ] ]
+        devnull = open(os.devnull, 'r+')
+        subprocess.Popen([ sys.executable, os.path.abspath(sys.argv[0]) ] + args + [ '--refresh' ],
+                         stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+
+    def find_host(self, name):
+        """Return the hostvars of a host from the index or the API."""
+        data = None
+        if not self.options.refresh_cache:
+            data = self.read_index(name)
+        if data is None:
+            try:
+                data = self.get_host(name, self.get_project_ids(self.projects, self.options.all_projects))
+            except (CloudStackException, requests.exceptions.RequestException), e:
+                if not self.region:
+                    raise
+                print >> sys.stderr, "Warning: Region %s failed: %s" % (self.region, e)
+                return {}
+            if data:
+                self.update_index(name, data)
+        if data and self.region:
+            data['region'] = self.region
+        return data
+
+
+    def find_merged_host(self, name):
+        """Return the hostvars of a host of this region, by its name in the merged inventory."""
+        data = self.find_host(name)
+        # Hosts with a name taken by another region are prefixed by the region
+        if not data and name.startswith(self.region + '_'):
+            data = self.find_host(name[len(self.region) + 1:])
+        return data
+
+
+    def json_dumps(self, data):
+        """Return compact JSON, encoded by ujson if it is installed."""
+        if ujson:
+            return ujson.dumps(data)
+        return json.dumps(data, separators=(',', ':'))
+
+
+    def print_json(self, data):
+        """Print the inventory, compact output is written group by group and host by host."""
+        if not self.compact:
+            print json.dumps(data, indent=2)
+            return
+        if '_meta' not in data:
+            print self.json_dumps(data)
+            return
+
+        out = sys.stdout
+        out.write('{')
+        for group_name, group in data.iteritems():
+            if group_name != '_meta':
+                out.write('%s:%s,' % (self.json_dumps(group_name), self.json_dumps(group)))
+        out.write('"_meta":{"hostvars":{')
+        separator = ''
+        for host_name, hostvars in data['_meta']['hostvars'].iteritems():
+            out.write('%s%s:%s' % (separator, self.json_dumps(host_name), self.json_dumps(hostvars)))
+            separator = ','
+        out.write('}}}\n')
+
+
+    def read_settings(self):
+        """Read the [cloudstack_inventory] section of the cloudstack.ini files read_config() uses."""
+        paths = [
+            os.path.join(os.path.expanduser('~'), '.cloudstack.ini'),
+            os.path.join(os.getcwd(), 'cloudstack.ini'),
+        ]
+        if 'CLOUDSTACK_CONFIG' in os.environ:
+            paths.append(os.path.expanduser(os.environ['CLOUDSTACK_CONFIG']))
+
+        self.config = ConfigParser.SafeConfigParser(self.settings)
+        self.config.read(paths)
+        if self.config.has_section('cloudstack_inventory'):
+            self.settings = dict(self.config.items('cloudstack_inventory'))
+
+        self.cache_path = os.path.expanduser(self.settings['cache_path'])
+        self.cache_max_age = int(self.settings['cache_max_age'])
+        self.full_refresh_interval = int(self.settings['full_refresh_interval'])
+        self.events_overlap = int(self.settings['events_overlap'])
+        self.regions = [ r.strip() for r in self.settings['regions'].split(',') if r.strip() ]
 
 
-    def get_host(self, name, project_id=''):
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if not hosts:
-            return {}
+    def get_cache_file(self, scope=''):
+        """Return the path of the cache file, scoped by API endpoint, key, projects and filters."""
+        scope = '%s|%s|%s' % (self.api_config.get('endpoint'), self.api_config.get('key'), scope)
+        return os.path.join(self.cache_path, 'ansible-cloudstack-%s.cache' % hashlib.sha1(scope).hexdigest())
 
+
+    def read_cache(self, expire=True, max_age=None):
+        """Return the cached inventory or None if it is missing or older than max_age (cache_max_age)."""
+        if self.cache_max_age <= 0:
+            return None
+        if max_age is None:
+            max_age = self.cache_max_age
+        try:
+            if expire and time.time() - os.path.getmtime(self.cache_file) > max_age:
+                return None
+            sections = self._read_file(self.cache_file, [ 'groups', 'hostvars' ])
+        except (IOError, OSError):
+            return None
+        if sections is None:
+            return None
+        data = sections['groups']
+        data['_meta'] = { 'hostvars': sections['hostvars'] }
+        return data
+
+
+    def read_state(self):
+        """Return the refresh state stored along with the cached inventory or None."""
+        try:
+            sections = self._read_file(self.cache_file, [ 'state' ])
+        except (IOError, OSError):
+            return None
+        return sections and sections['state']
+
+
+    def write_cache(self, data):
+        """Write the inventory with its refresh state and the host index."""
+        if self.cache_max_age <= 0:
+            return
+        groups = dict((name, group) for name, group in data.iteritems() if name != '_meta')
+        try:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            self._write_file(self.cache_file, [ ('groups', groups), ('hostvars', data['_meta']['hostvars']),
+                                                ('state', self.state) ])
+        except (IOError, OSError, ValueError), e:
+            print >> sys.stderr, "Warning: Could not write cache %s: %s" % (self.cache_file, e)
+            return
+        self.write_index(data['_meta']['hostvars'])
+
+        # Drop the JSON cache of releases before the binary format
+        base = os.path.splitext(self.cache_file)[0]
+        for path in [ base + '.json', base + '.state' ]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+    def _read_file(self, path, names):
+        """Return the named sections of a cache file, None (and the file is dropped) if its format is stale.
+
+        The file is memory-mapped and only the requested sections are unmarshaled.
+        """
+        f = open(path, 'rb')
+        try:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # Empty file
+                mm = ''
+        finally:
+            f.close()
+        try:
+            header_size = struct.calcsize('<8s16sI')
+            magic, cache_format, toc_size = struct.unpack('<8s16sI', mm[:header_size])
+            if magic != 'ANSCSINV' or cache_format.rstrip('\0') != self.cache_format:
+                raise ValueError('stale cache format')
+            toc = marshal.loads(mm[header_size:header_size + toc_size])
+            offset = header_size + toc_size
+            sections = {}
+            for name in names:
+                start, size = toc[name]
+                sections[name] = marshal.loads(mm[offset + start:offset + start + size])
+            return sections
+        except (struct.error, ValueError, EOFError, TypeError, KeyError):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        finally:
+            if mm:
+                mm.close()
+
+
+    def _write_file(self, path, sections):
+        """Write the sections to a temp file and rename it, readers never see a partial file.
+
+        The file starts with a magic, the cache format and a table of contents
+        of the marshaled sections by name, offset and size.
+        """
+        toc = {}
+        offset = 0
+        blobs = []
+        for name, data in sections:
+            blob = marshal.dumps(data)
+            toc[name] = (offset, len(blob))
+            offset += len(blob)
+            blobs.append(blob)
+        toc = marshal.dumps(toc)
+
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_path, prefix='.ansible-cloudstack-')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(struct.pack('<8s16sI', 'ANSCSINV', self.cache_format, len(toc)))
+                f.write(toc)
+                for blob in blobs:
+                    f.write(blob)
+            finally:
+                f.close()
+            os.rename(tmp_file, path)
+        except:
+            os.unlink(tmp_file)
+            raise
+
+
+    def write_index(self, hostvars):
+        """Build the host index in a temp file and rename it over the previous one."""
+        try:
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_path, prefix='.ansible-cloudstack-', suffix='.db')
+            os.close(fd)
+            try:
+                conn = sqlite3.connect(tmp_file)
+                try:
+                    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+                    conn.execute('CREATE TABLE hosts (name TEXT PRIMARY KEY, hostvars BLOB)')
+                    conn.execute("INSERT INTO meta VALUES ('created', ?)", (repr(time.time()),))
+                    conn.execute("INSERT INTO meta VALUES ('format', ?)", (self.cache_format,))
+                    conn.executemany('INSERT OR REPLACE INTO hosts VALUES (?, ?)',
+                                     ((name, sqlite3.Binary(marshal.dumps(host))) for name, host in hostvars.iteritems()))
+                    conn.commit()
+                finally:
+                    conn.close()
+                os.rename(tmp_file, self.index_file)
+            except:
+                os.unlink(tmp_file)
+                raise
+        except (IOError, OSError, sqlite3.Error), e:
+            print >> sys.stderr, "Warning: Could not write index %s: %s" % (self.index_file, e)
+
+
+    def _connect_index(self):
+        """Return a connection to the index or None if it is missing, of a stale format or older than cache_max_age."""
+        if self.cache_max_age <= 0 or not os.path.exists(self.index_file):
+            return None
+        conn = sqlite3.connect(self.index_file)
+        meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+        if meta.get('format') != self.cache_format or time.time() - float(meta.get('created', 0)) > self.cache_max_age:
+            conn.close()
+            return None
+        return conn
+
+
+    def read_index(self, name):
+        """Return the hostvars of a host from the index or None on a miss."""
+        try:
+            conn = self._connect_index()
+            if not conn:
+                return None
+            try:
+                row = conn.execute('SELECT hostvars FROM hosts WHERE name = ?', (name,)).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+        if row:
+            return marshal.loads(str(row[0]))
+        return None
+
+
+    def update_index(self, name, host):
+        """Add a host fetched from the API to a valid index."""
+        try:
+            conn = self._connect_index()
+            if not conn:
+                return
+            try:
+                conn.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?)', (name, sqlite3.Binary(marshal.dumps(host))))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+
+    def _get_session(self):
+        """Return a keep-alive session shared by all API calls."""
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session = CloudStackSession()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+    def iter_list(self, command, result_key, **args):
+        """Yield the records of a listing, page by page."""
+        page = 1
+        seen = 0
+        while True:
+            args['page'] = page
+            args['pagesize'] = self.page_size
+            res = getattr(self.cs, command)(**args)
+            if not res or result_key not in res:
+                return
+
+            records = res[result_key]
+            for record in records:
+                yield record
+            seen += len(records)
+
+            if len(records) < self.page_size or seen >= res.get('count', seen + 1):
+                return
+            page += 1
+
+
+    def get_project_ids(self, projects, all_projects=False):
+        """Return the project ids to collect, '' stands for the account scope."""
+        if not projects and not all_projects:
+            return [ '' ]
+
+        project_ids = {}
+        for p in self.iter_list('listProjects', 'project', listall=True):
+            project_ids[p['name']] = p['id']
+            project_ids[p['id']] = p['id']
+
+        if all_projects:
+            return [ '' ] + sorted(set(project_ids.values()))
+
+        for project in projects:
+            if project not in project_ids:
+                # sys.exit() in a worker thread of map_regions() would hang the pool
+                raise CloudStackInventoryError("Project %s not found." % project)
+        return [ project_ids[project] for project in projects ]
+
+
+    def get_vm_filters(self):
+        """Return the filter arguments of listVirtualMachines, None if the zone does not exist."""
+        if self.vm_filters is None:
+            filters = {}
+            if self.zone:
+                # The zone may be given by name or id, listZones(name=...) would not match an id
+                zone_ids = [ z['id'] for z in self.iter_list('listZones', 'zone') if self.zone in [ z['name'], z['id'] ] ]
+                if not zone_ids:
+                    if not self.region:
+                        raise CloudStackInventoryError("Zone %s not found." % self.zone)
+                    print >> sys.stderr, "Warning: Zone %s not found in region %s." % (self.zone, self.region)
+                    # Remembered, the region lists no VMs
+                    self.vm_filters = False
+                    return None
+                filters['zoneid'] = zone_ids[0]
+            if self.vm_state:
+                filters['state'] = self.vm_state
+            if self.tags:
+                filters['tags'] = self.tags
+            if self.keyword:
+                filters['keyword'] = self.keyword
+            self.vm_filters = filters
+        if self.vm_filters is False:
+            return None
+        return self.vm_filters
+
+
+    def list_vms(self, project_id, **args):
+        """Yield the VMs of a scope matching the filters."""
+        filters = self.get_vm_filters()
+        if filters is None:
+            return iter([])
+        args.update(filters)
+        if self.details:
+            args.setdefault('details', self.details)
+        return self.iter_list('listVirtualMachines', 'virtualmachine', projectid=project_id, **args)
+
+
+    def get_scope(self, project_id):
+        """Return the newest event, the instance groups and VMs of a project or the account scope ('')."""
+        # Taken before the listing, later events are replayed by the next incremental refresh.
+        # The API lists events newest first.
+        events = self.cs.listEvents(projectid=project_id, listall=True, page=1, pagesize=1)
+        groups = list(self.iter_list('listInstanceGroups', 'instancegroup', projectid=project_id))
+        hosts = list(self.list_vms(project_id))
+        return events.get('event', [])[:1], groups, hosts
+
+
+    def map_scopes(self, func, project_ids):
+        """Call func for each scope concurrently, bounded by the size of the connection pool."""
+        if len(project_ids) == 1:
+            return [ func(project_ids[0]) ]
+        pool = ThreadPool(min(self.pool_size, len(project_ids)))
+        try:
+            return pool.map(func, project_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def get_host(self, name, project_ids=['']):
+        for project_id in project_ids:
+            for host in self.list_vms(project_id, details='min'):
+                if name == host['displayname']:
+                    for vm in self.list_vms(project_id, id=host['id']):
+                        return self.get_hostvars(vm)
+        return {}
+
+
+    def get_hostvars(self, host):
         data = {}
-        for host in hosts['virtualmachine']:
-            host_name = host['displayname']
-            if name == host_name:
-                data['zone'] = host['zonename']
-                if 'group' in host:
-                    data['group'] = host['group']
-                data['state'] = host['state']
-                data['service_offering'] = host['serviceofferingname']
-                data['affinity_group'] = host['affinitygroup']
-                data['security_group'] = host['securitygroup']
-                data['cpu_number'] = host['cpunumber']
-                data['cpu_speed'] = host['cpuspeed']
-                if 'cpuused' in host:
-                    data['cpu_used'] = host['cpuused']
-                data['memory'] = host['memory']
-                data['tags'] = host['tags']
-                data['hypervisor'] = host['hypervisor']
-                data['created'] = host['created']
-                data['nic'] = []
-                for nic in host['nic']:
-                    data['nic'].append({
-                        'ip': nic['ipaddress'],
-                        'mac': nic['macaddress'],
-                        'netmask': nic['netmask'],
-                        'gateway': nic['gateway'],
-                        'type': nic['type'],
-                    })
-                    if nic['isdefault']:
-                        data['default_ip'] = nic['ipaddress']
-                break;
+        data['zone'] = host['zonename']
+        if 'group' in host:
+            data['group'] = host['group']
+        if 'project' in host:
+            data['project'] = host['project']
+        data['state'] = host['state']
+        # Details left out of the listing are not set
+        if 'serviceofferingname' in host:
+            data['service_offering'] = host['serviceofferingname']
+            data['cpu_number'] = host['cpunumber']
+            data['cpu_speed'] = host['cpuspeed']
+            data['memory'] = host['memory']
+        if 'affinitygroup' in host:
+            data['affinity_group'] = host['affinitygroup']
+        if 'securitygroup' in host:
+            data['security_group'] = host['securitygroup']
+        if 'cpuused' in host:
+            data['cpu_used'] = host['cpuused']
+        data['tags'] = host.get('tags', [])
+        data['hypervisor'] = host['hypervisor']
+        data['created'] = host['created']
+        if 'nic' in host:
+            data['nic'] = []
+            for nic in host['nic']:
+                data['nic'].append({
+                    'ip': nic['ipaddress'],
+                    'mac': nic['macaddress'],
+                    'netmask': nic['netmask'],
+                    'gateway': nic['gateway'],
+                    'type': nic['type'],
+                })
+                if nic['isdefault']:
+                    data['default_ip'] = nic['ipaddress']
         return data
 
 
-    def get_list(self, project_id=''):
+    def get_list(self, project_ids=['']):
         data = {
             'all': {
                 'hosts': [],
@@ -176,56 +926,174 @@ class CloudStackInventory(object):
                 },
             }
 
-        groups = self.cs.listInstanceGroups(projectid=project_id)
-        if groups:
-            for group in groups['instancegroup']:
+        started = time.time()
+        scopes = self.map_scopes(self.get_scope, project_ids)
+
+        for events, groups, hosts in scopes:
+            for group in groups:
                 group_name = group['name']
                 if group_name and not group_name in data:
                     data[group_name] = {
                             'hosts': []
                         }
 
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if hosts:
-            for host in hosts['virtualmachine']:
-                host_name = host['displayname']
-                data['all']['hosts'].append(host_name)
-                data['_meta']['hostvars'][host_name] = {}
-                data['_meta']['hostvars'][host_name]['zone'] = host['zonename']
-                if 'group' in host:
-                    data['_meta']['hostvars'][host_name]['group'] = host['group']
-                data['_meta']['hostvars'][host_name]['state'] = host['state']
-                data['_meta']['hostvars'][host_name]['service_offering'] = host['serviceofferingname']
-                data['_meta']['hostvars'][host_name]['affinity_group'] = host['affinitygroup']
-                data['_meta']['hostvars'][host_name]['security_group'] = host['securitygroup']
-                data['_meta']['hostvars'][host_name]['cpu_number'] = host['cpunumber']
-                data['_meta']['hostvars'][host_name]['cpu_speed'] = host['cpuspeed']
-                if 'cpuused' in host:
-                    data['_meta']['hostvars'][host_name]['cpu_used'] = host['cpuused']
-                data['_meta']['hostvars'][host_name]['memory'] = host['memory']
-                data['_meta']['hostvars'][host_name]['tags'] = host['tags']
-                data['_meta']['hostvars'][host_name]['hypervisor'] = host['hypervisor']
-                data['_meta']['hostvars'][host_name]['created'] = host['created']
-                data['_meta']['hostvars'][host_name]['nic'] = []
-                for nic in host['nic']:
-                    data['_meta']['hostvars'][host_name]['nic'].append({
-                        'ip': nic['ipaddress'],
-                        'mac': nic['macaddress'],
-                        'netmask': nic['netmask'],
-                        'gateway': nic['gateway'],
-                        'type': nic['type'],
-                        })
-                    if nic['isdefault']:
-                        data['_meta']['hostvars'][host_name]['default_ip'] = nic['ipaddress']
-
-                group_name = ''
-                if 'group' in host:
-                    group_name = host['group']
-
-                if group_name and group_name in data:
-                    data[group_name]['hosts'].append(host_name)
+        vms = {}
+        for events, groups, hosts in scopes:
+            for host in hosts:
+                self.add_host(data, host)
+                vms[host['id']] = host['displayname']
+
+        self.state = {
+            'project_ids': project_ids,
+            'full_refresh': started,
+            'since': None,
+            'since_offset': 0,
+            'vms': vms,
+        }
+        self.update_events_mark(self.state, [ event for events, groups, hosts in scopes for event in events ])
+        return data
+
+
+    def add_host(self, data, host):
+        host_name = host['displayname']
+        if host_name not in data['_meta']['hostvars']:
+            data['all']['hosts'].append(host_name)
+        data['_meta']['hostvars'][host_name] = self.get_hostvars(host)
+
+        # The inventory is the index of groups to hosts, each host is added to its groups once
+        for group_name in self.get_host_groups(host):
+            if group_name not in data:
+                data[group_name] = {
+                        'hosts': []
+                    }
+            data[group_name]['hosts'].append(host_name)
+
+
+    def to_safe(self, word):
+        return re.sub(r'[^A-Za-z0-9_\-]', '_', word)
+
+
+    def get_host_groups(self, host):
+        groups = []
+        if host.get('group'):
+            groups.append(host['group'])
+
+        # Make a group per project
+        if 'project' in host:
+            groups.append(host['project'])
+
+        if 'tags' in self.group_by:
+            for tag in host.get('tags', []):
+                groups.append(self.to_safe('tag_%s' % tag['key']))
+                groups.append(self.to_safe('tag_%s_%s' % (tag['key'], tag['value'])))
+
+        if 'zone' in self.group_by:
+            groups.append(self.to_safe('zone_%s' % host['zonename']))
+
+        if 'service_offering' in self.group_by and 'serviceofferingname' in host:
+            groups.append(self.to_safe('service_offering_%s' % host['serviceofferingname']))
+
+        if 'network' in self.group_by:
+            for nic in host.get('nic', []):
+                if 'networkname' in nic:
+                    groups.append(self.to_safe('network_%s' % nic['networkname']))
+
+        # A VM may have several nics in one network
+        return sorted(set(groups), key=groups.index)
+
+
+    def remove_hosts(self, data, host_names):
+        for group_name, group in data.iteritems():
+            if group_name != '_meta':
+                group['hosts'] = [ h for h in group['hosts'] if h not in host_names ]
+        for host_name in host_names:
+            data['_meta']['hostvars'].pop(host_name, None)
+
+
+    def is_vm_event(self, event):
+        if event['type'] in self.tag_events:
+            # Tags of networks, templates, volumes etc. do not change a VM
+            return event.get('resourcetype', 'UserVm') == 'UserVm'
+        return event['type'].startswith('VM.')
+
+
+    def parse_event_time(self, created):
+        """Return the UTC timestamp and the UTC offset in seconds of an event time, e.g. 2014-07-02T07:53:50+0200."""
+        # Not parsed by time.strptime(), its lazy import races in the worker threads of Python 2
+        match = re.match(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:([+-])(\d\d):?(\d\d))?', created)
+        if not match:
+            raise ValueError("Unknown time format: %s" % created)
+        offset = 0
+        if match.group(7):
+            offset = int(match.group(8)) * 3600 + int(match.group(9)) * 60
+            if match.group(7) == '-':
+                offset = -offset
+        server_time = calendar.timegm([ int(v) for v in match.group(1, 2, 3, 4, 5, 6) ])
+        return server_time - offset, offset
+
+
+    def update_events_mark(self, state, events):
+        """Advance the mark of the newest event seen by the created times of events."""
+        # Only the server's event times are used, never the clock of this host: the API reads
+        # startdate in the time zone of the management server.
+        for event in events:
+            created, offset = self.parse_event_time(event['created'])
+            if state['since'] is None or created > state['since']:
+                state['since'] = created
+                state['since_offset'] = offset
+
+
+    def refresh_list(self, project_ids):
+        """Update the previous inventory by the VM events since the last refresh, None if a full rebuild is due."""
+        if self.full_refresh_interval <= 0:
+            return None
+        data = self.read_cache(expire=False)
+        state = self.read_state()
+        if not data or not state or state['project_ids'] != project_ids or 'since_offset' not in state \
+                or time.time() - state['full_refresh'] > self.full_refresh_interval:
+            return None
+
+        # Formatted in the time zone of the server, by the offset of its newest event.
+        # Without any event seen yet, all events are listed.
+        args = {}
+        if state['since'] is not None:
+            since = state['since'] - self.events_overlap + state['since_offset']
+            args['startdate'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since))
+        events = self.map_scopes(lambda project_id: list(self.iter_list('listEvents', 'event',
+                                 projectid=project_id, listall=True, **args)), project_ids)
+        events = [ e for scope_events in events for e in scope_events ]
+        self.update_events_mark(state, events)
+
+        vm_ids = set()
+        for event in [ e for e in events if self.is_vm_event(e) ]:
+            # Older APIs do not return the resource of an event, nor the type of a tagged resource
+            if 'resourceid' not in event or event['type'] in self.tag_events and 'resourcetype' not in event:
+                return None
+            vm_ids.add(event['resourceid'])
+
+        # Fetching many VMs by id costs more requests than a full rebuild
+        vms = state['vms']
+        requests_by_id = (len(vm_ids) + self.ids_per_request - 1) / self.ids_per_request * len(project_ids)
+        if requests_by_id >= len(project_ids) * 2 + len(vms) / self.page_size:
+            return None
+
+        self.remove_hosts(data, set([ vms.pop(vm_id) for vm_id in vm_ids if vm_id in vms ]))
+
+        vm_ids = sorted(vm_ids)
+        for i in range(0, len(vm_ids), self.ids_per_request):
+            ids = ','.join(vm_ids[i:i + self.ids_per_request])
+            for hosts in self.map_scopes(lambda project_id: list(self.list_vms(project_id, ids=ids)), project_ids):
+                for host in hosts:
+                    self.add_host(data, host)
+                    vms[host['id']] = host['displayname']
+
+        self.state = state
         return data
 
 
 if __name__ == '__main__':
-    CloudStackInventory()
+    try:
+        CloudStackInventory()
+    except CloudStackInventoryError, e:
+        print >> sys.stderr, "Error: %s" % e
+        sys.exit(1)
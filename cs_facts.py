@@ -24,6 +24,7 @@ module: cs_facts
 short_description: Gather facts on instances of Apache CloudStack based clouds.
 description:
      - This module fetches data from the metadata API in CloudStack. The module must be called from within the instance itself.
+     - The metadata API is served by the DHCP server of the newest lease of dhclient, systemd-networkd or NetworkManager.
 version_added: '2.0'
 author: "René Moser (@resmo)"
 options:
@@ -41,6 +42,35 @@ options:
       - cloudstack_local_ipv4
       - cloudstack_instance_id
       - cloudstack_user_data
+  timeout:
+    description:
+      - Seconds to wait for a response of the metadata API, per request. The facts are fetched concurrently.
+    required: false
+    default: 5
+  fail_on_error:
+    description:
+      - Fail if a fact could not be fetched, e.g. by a timeout. Otherwise the fact is C(null) and its name returned in C(failed_facts).
+      - Facts not provided by the metadata API (HTTP 404) are C(null) and do not fail.
+    required: false
+    default: false
+    choices: [ 'yes', 'no' ]
+  cache_file:
+    description:
+      - File on the instance the facts are cached in.
+    required: false
+    default: '~/.ansible/tmp/cs_facts.json'
+  cache_ttl:
+    description:
+      - Seconds the cached facts are used, C(0) disables the cache.
+      - The cache is dropped as well if the DHCP server identifier or the modification time of the lease file changes.
+    required: false
+    default: 3600
+  refresh:
+    description:
+      - Fetch the facts from the metadata API even if they are cached.
+    required: false
+    default: false
+    choices: [ 'yes', 'no' ]
 requirements: [ 'yaml' ]
 '''
 
@@ -52,6 +82,14 @@ EXAMPLES = '''
 # Gather specific fact on instances
 - name: Gather cloudstack facts
   cs_facts: filter=cloudstack_instance_id
+
+# Fail if the virtual router does not answer within 2 seconds
+- name: Gather cloudstack facts
+  cs_facts: timeout=2 fail_on_error=yes
+
+# Bypass the local facts cache
+- name: Gather cloudstack facts
+  cs_facts: refresh=yes
 '''
 
 RETURN = '''
@@ -96,9 +134,21 @@ cloudstack_user_data:
   returned: success
   type: dict
   sample: { "bla": "foo" }
+failed_facts:
+  description: facts which could not be fetched, e.g. by a timeout.
+  returned: success
+  type: list
+  sample: [ "cloudstack_public_hostname" ]
 '''
 
 import os
+import glob
+import json
+import base64
+import mmap
+import time
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 try:
     import yaml
@@ -112,8 +162,12 @@ CS_USERDATA_BASE_URL = "http://%s/latest/user-data"
 class CloudStackFacts(object):
 
     def __init__(self):
-        self.facts = ansible_facts(module)
+        # Gathered only if the lease file must be looked up by the default interface
+        self.facts = None
         self.api_ip = None
+        self.dhcp_lease_file = None
+        self.cache = None
+        self.cache_created = time.time()
         self.fact_paths = {
             'cloudstack_service_offering':  'service-offering',
             'cloudstack_availability_zone': 'availability-zone',
@@ -123,45 +177,163 @@ class CloudStackFacts(object):
             'cloudstack_local_ipv4':        'local-ipv4',
             'cloudstack_instance_id':       'instance-id'
         }
+        self.failed_facts = {}
 
     def run(self):
-        result = {}
+        urls = {}
         filter = module.params.get('filter')
-        if not filter:
-            for key,path in self.fact_paths.iteritems():
-                result[key] = self._fetch(CS_METADATA_BASE_URL + "/" + path)
-            result['cloudstack_user_data'] = self._get_user_data_json()
-        else:
-            if filter == 'cloudstack_user_data':
-                result['cloudstack_user_data'] = self._get_user_data_json()
-            elif filter in self.fact_paths:
-                result[filter] = self._fetch(CS_METADATA_BASE_URL + "/" + self.fact_paths[filter])
+        for key,path in self.fact_paths.iteritems():
+            if not filter or filter == key:
+                urls[key] = CS_METADATA_BASE_URL + "/" + path
+        if not filter or filter == 'cloudstack_user_data':
+            urls['cloudstack_user_data'] = CS_USERDATA_BASE_URL
+
+        # Resolve the API IP before the workers start, they must not fail the module
+        self._get_api_ip()
+
+        facts = {}
+        if not module.params.get('refresh'):
+            facts = self._read_cache()
+
+        # Each fetch is a round trip to the virtual router, fetch them concurrently
+        keys = [ key for key in urls.keys() if key not in facts ]
+        if keys:
+            pool = ThreadPool(len(keys))
+            try:
+                facts.update(zip(keys, pool.map(lambda key: self._fetch(urls[key], key), keys)))
+            finally:
+                pool.close()
+                pool.join()
+            # Partial results are not cached
+            if not self.failed_facts:
+                self._write_cache(facts)
+
+        # The raw user data is cached, it is parsed on every run
+        result = dict((key, facts[key]) for key in urls.keys())
+        if 'cloudstack_user_data' in result:
+            result['cloudstack_user_data'] = self._get_user_data_json(result['cloudstack_user_data'])
+
+        if self.failed_facts and module.params.get('fail_on_error'):
+            module.fail_json(msg="Could not fetch facts: %s" % ', '.join(
+                [ "%s (%s)" % (key, msg) for key, msg in sorted(self.failed_facts.iteritems()) ]))
         return result
 
 
-    def _get_user_data_json(self):
+    def _get_lease(self):
+        """Return the identity of the DHCP lease the cached facts are valid for."""
+        return {
+            'file':   self.dhcp_lease_file,
+            'mtime':  os.path.getmtime(self.dhcp_lease_file),
+            'server': self.api_ip,
+        }
+
+
+    def _load_cache(self):
+        """Return the content of the cache file, expired or not."""
+        if self.cache is None:
+            self.cache = {}
+            if module.params.get('cache_ttl') <= 0:
+                return self.cache
+            try:
+                f = open(os.path.expanduser(module.params.get('cache_file')))
+                try:
+                    cache = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                return self.cache
+            if isinstance(cache, dict):
+                self.cache = cache
+        return self.cache
+
+
+    def _read_cache(self):
+        """Return the cached facts, empty if the cache expired or the DHCP lease changed."""
+        cache = self._load_cache()
+        if not cache or time.time() - cache.get('created', 0) > module.params.get('cache_ttl') \
+                or cache.get('lease') != self._get_lease():
+            return {}
+        # Facts added to the cache later on expire along with it
+        self.cache_created = cache['created']
+        facts = dict(cache.get('facts', {}))
+        if cache.get('user_data') is not None:
+            try:
+                facts['cloudstack_user_data'] = base64.b64decode(cache['user_data'])
+            except TypeError:
+                return {}
+        elif 'user_data' in cache:
+            facts['cloudstack_user_data'] = None
+        return facts
+
+
+    def _write_cache(self, facts):
+        if module.params.get('cache_ttl') <= 0:
+            return
+        cache_file = os.path.expanduser(module.params.get('cache_file'))
+        cache = { 'created': self.cache_created, 'lease': self._get_lease(), 'facts': dict(facts) }
+        # User data may be binary, e.g. gzip'd cloud-init, which JSON can not store
+        if 'cloudstack_user_data' in facts:
+            user_data = cache['facts'].pop('cloudstack_user_data')
+            if user_data is not None:
+                user_data = base64.b64encode(user_data)
+            cache['user_data'] = user_data
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # Write to a temp file and rename it, readers never see a partial file
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.%s.' % os.path.basename(cache_file))
+            try:
+                f = os.fdopen(fd, 'w')
+                try:
+                    json.dump(cache, f)
+                finally:
+                    f.close()
+                os.rename(tmp_file, cache_file)
+            except:
+                os.unlink(tmp_file)
+                raise
+        except (IOError, OSError, ValueError):
+            # The facts are fetched again next time
+            pass
+
+
+    def _get_user_data_json(self, data):
         try:
             # this data come form users, we try what we can to parse it...
-            return yaml.load(self._fetch(CS_USERDATA_BASE_URL))
+            return yaml.load(data)
         except:
             return None
 
 
-    def _fetch(self, path):
+    def _fetch(self, path, key=None):
         api_ip = self._get_api_ip()
         if not api_ip:
             return None
         api_url = path % api_ip
-        (response, info) = fetch_url(module, api_url, force=True)
+        (response, info) = fetch_url(module, api_url, force=True, timeout=module.params.get('timeout'))
+        data = None
         if response:
-            data = response.read()
-        else:
-            data = None
+            try:
+                data = response.read()
+            except IOError, e:
+                # Timeout while reading the response
+                info['msg'] = str(e)
+                response = None
+        # A fact missing in the metadata (404) is no failure
+        if not response and key and info.get('status') != 404:
+            self.failed_facts[key] = info.get('msg')
         return data
 
 
     def _get_dhcp_lease_file(self):
-        """Return the path of the lease file."""
+        """Return the path of the lease file, the one of the previous run if it still exists."""
+        lease = self._load_cache().get('lease')
+        if isinstance(lease, dict) and lease.get('file') and os.path.exists(lease['file']):
+            return lease['file']
+
+        if self.facts is None:
+            self.facts = ansible_facts(module)
         default_iface = self.facts['default_ipv4']['interface']
         dhcp_lease_file_locations = [
             '/var/lib/dhcp/dhclient.%s.leases' % default_iface, # debian / ubuntu
@@ -169,22 +341,57 @@ class CloudStackFacts(object):
             '/var/lib/dhclient/dhclient--%s.lease' % default_iface, # centos 7
             '/var/db/dhclient.leases.%s' % default_iface, # openbsd
         ]
+        # NetworkManager, dhclient-<uuid>-<iface>.lease or internal-<uuid>-<iface>.lease, newest connection first
+        dhcp_lease_file_locations += sorted(glob.glob('/var/lib/NetworkManager/*-%s.lease' % default_iface),
+                                            key=os.path.getmtime, reverse=True)
+        # systemd-networkd, by interface index
+        try:
+            f = open('/sys/class/net/%s/ifindex' % default_iface)
+            try:
+                dhcp_lease_file_locations.append('/run/systemd/netif/leases/%s' % f.read().strip())
+            finally:
+                f.close()
+        except IOError:
+            pass
+
         for file_path in dhcp_lease_file_locations:
             if os.path.exists(file_path):
                 return file_path
         module.fail_json(msg="Could not find dhclient leases file.")
 
 
+    def _parse_dhcp_lease_file(self, dhcp_lease_file):
+        """Return the DHCP server of the newest lease, searched from the end of the file."""
+        f = open(dhcp_lease_file)
+        try:
+            try:
+                leases = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # Empty file
+                return None
+        finally:
+            f.close()
+        try:
+            # dhclient appends "option dhcp-server-identifier 185.19.28.176;" per lease,
+            # systemd-networkd and NetworkManager write "SERVER_ADDRESS=185.19.28.176"
+            for marker in [ 'dhcp-server-identifier ', 'SERVER_ADDRESS=' ]:
+                start = leases.rfind(marker)
+                if start < 0:
+                    continue
+                end = leases.find('\n', start)
+                if end < 0:
+                    end = leases.size()
+                return leases[start + len(marker):end].translate(None, ';').strip() or None
+        finally:
+            leases.close()
+        return None
+
+
     def _get_api_ip(self):
         """Return the IP of the DHCP server."""
         if not self.api_ip:
-            dhcp_lease_file = self._get_dhcp_lease_file()
-            for line in open(dhcp_lease_file):
-                if 'dhcp-server-identifier' in line:
-                    # get IP of string "option dhcp-server-identifier 185.19.28.176;"
-                    line = line.translate(None, ';')
-                    self.api_ip = line.split()[2]
-                    break
+            self.dhcp_lease_file = self._get_dhcp_lease_file()
+            self.api_ip = self._parse_dhcp_lease_file(self.dhcp_lease_file)
             if not self.api_ip:
                 module.fail_json(msg="No dhcp-server-identifier found in leases file.")
         return self.api_ip
@@ -204,6 +411,11 @@ def main():
                 'cloudstack_instance_id',
                 'cloudstack_user_data',
             ]),
+            timeout = dict(type='int', default=5),
+            fail_on_error = dict(type='bool', default=False),
+            cache_file = dict(default='~/.ansible/tmp/cs_facts.json'),
+            cache_ttl = dict(type='int', default=3600),
+            refresh = dict(type='bool', default=False),
         ),
         supports_check_mode=False
     )
@@ -211,8 +423,9 @@ def main():
     if not has_lib_yaml:
         module.fail_json(msg="missing python library: yaml")
 
-    cs_facts = CloudStackFacts().run()
-    cs_facts_result = dict(changed=False, ansible_facts=cs_facts)
+    cloudstack_facts = CloudStackFacts()
+    cs_facts = cloudstack_facts.run()
+    cs_facts_result = dict(changed=False, ansible_facts=cs_facts, failed_facts=sorted(cloudstack_facts.failed_facts.keys()))
     module.exit_json(**cs_facts_result)
 
 from ansible.module_utils.basic import *
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+"""
+CloudStack modules benchmark.
+=============================
+
+Runs the cs_* modules against the local API simulator through their create,
+idempotent re-run, update and delete paths at several dataset sizes and records
+per step: API calls (all and list*), TCP connections, response bytes, wall time
+and peak RSS of the ansible-playbook process.
+
+  benchmark.py --sizes 100,1000,10000 --save benchmark_baseline.json
+
+Used as a regression gate, a run is compared to a saved baseline and fails
+(exit code 1) if a step issues more API or list calls than recorded, or if an
+idempotent re-run reports a change. Independent of a baseline, a run with
+--job-duration fails if a step awaiting several jobs at once (CONCURRENT_JOBS)
+waits for their sum instead of the slowest one:
+
+  benchmark.py --sizes 100,1000 --check benchmark_baseline.json
+
+
+usage: benchmark.py [--sizes SIZES] [--modules MODULES] [--latency SECONDS]
+                    [--job-duration SECONDS] [--ansible-playbook PATH] [--python PATH]
+                    [--save FILE] [--check FILE] [--json FILE]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import json
+except:
+    import simplejson as json
+
+from cloudstack_simulator import CloudStackSimulator, start_server
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARY_DIR = os.path.dirname(TESTS_DIR)
+
+# Steps per module, in order. Names refer to resources of the simulator dataset.
+SCENARIOS = {
+    'cs_instance': [
+        ('create', { 'name': 'bench-vm', 'template': 'Linux Debian 7 64-bit', 'service_offering': 'Tiny',
+                     'zone': 'ch-gva-2', 'tags': [ { 'key': 'tier', 'value': 'web' } ] }),
+        ('idempotent', { 'name': 'bench-vm', 'template': 'Linux Debian 7 64-bit', 'service_offering': 'Tiny',
+                         'zone': 'ch-gva-2', 'tags': [ { 'key': 'tier', 'value': 'web' } ] }),
+        ('update', { 'name': 'bench-vm', 'template': 'Linux Debian 7 64-bit', 'service_offering': 'Small',
+                     'zone': 'ch-gva-2', 'force': True, 'tags': [ { 'key': 'tier', 'value': 'db' } ] }),
+        ('retag', { 'name': 'bench-vm', 'template': 'Linux Debian 7 64-bit', 'service_offering': 'Small',
+                    'zone': 'ch-gva-2', 'tags': [ { 'key': 'env', 'value': 'prod' } ] }),
+        ('delete', { 'name': 'bench-vm', 'state': 'expunged' }),
+    ],
+    'cs_firewall': [
+        ('create', { 'ip_address': '185.19.28.10', 'start_port': 8080 }),
+        ('idempotent', { 'ip_address': '185.19.28.10', 'start_port': 8080 }),
+        ('delete', { 'ip_address': '185.19.28.10', 'start_port': 8080, 'state': 'absent' }),
+    ],
+    'cs_securitygroup': [
+        ('create', { 'name': 'bench-sg' }),
+        ('idempotent', { 'name': 'bench-sg' }),
+        ('delete', { 'name': 'bench-sg', 'state': 'absent' }),
+    ],
+    'cs_securitygroup_rule': [
+        ('create', { 'security_group': 'default', 'start_port': 8080 }),
+        ('idempotent', { 'security_group': 'default', 'start_port': 8080 }),
+        ('delete', { 'security_group': 'default', 'start_port': 8080, 'state': 'absent' }),
+    ],
+    'cs_portforward': [
+        ('create', { 'ip_address': '185.19.28.10', 'vm': 'vm-00000', 'public_port': 2222, 'private_port': 22 }),
+        ('idempotent', { 'ip_address': '185.19.28.10', 'vm': 'vm-00000', 'public_port': 2222, 'private_port': 22 }),
+        ('update', { 'ip_address': '185.19.28.10', 'vm': 'vm-00000', 'public_port': 2222, 'private_port': 2200 }),
+        ('delete', { 'ip_address': '185.19.28.10', 'public_port': 2222, 'private_port': 2200, 'state': 'absent' }),
+    ],
+    'cs_network': [
+        ('create', { 'name': 'bench-net', 'network_offering': 'DefaultIsolatedNetworkOfferingWithSourceNatService',
+                     'zone': 'ch-gva-2' }),
+        ('idempotent', { 'name': 'bench-net', 'network_offering': 'DefaultIsolatedNetworkOfferingWithSourceNatService',
+                         'zone': 'ch-gva-2' }),
+        ('update', { 'name': 'bench-net', 'displaytext': 'Benchmark network',
+                     'network_offering': 'DefaultIsolatedNetworkOfferingWithSourceNatService', 'zone': 'ch-gva-2' }),
+        ('delete', { 'name': 'bench-net', 'zone': 'ch-gva-2', 'state': 'absent' }),
+    ],
+    'cs_template': [
+        ('create', { 'name': 'bench-tpl', 'url': 'http://example.com/bench.qcow2', 'os_type': 'Debian GNU/Linux 7(64-bit)',
+                     'zone': 'ch-gva-2', 'hypervisor': 'KVM', 'format': 'QCOW2' }),
+        ('idempotent', { 'name': 'bench-tpl', 'url': 'http://example.com/bench.qcow2', 'os_type': 'Debian GNU/Linux 7(64-bit)',
+                         'zone': 'ch-gva-2', 'hypervisor': 'KVM', 'format': 'QCOW2' }),
+        ('delete', { 'name': 'bench-tpl', 'url': 'http://example.com/bench.qcow2', 'os_type': 'Debian GNU/Linux 7(64-bit)',
+                     'zone': 'ch-gva-2', 'hypervisor': 'KVM', 'format': 'QCOW2', 'state': 'absent' }),
+    ],
+}
+
+
+# Steps awaiting several independent async jobs at once, with their number of jobs.
+# With --job-duration, waiting for them must take about as long as the slowest job.
+CONCURRENT_JOBS = {
+    ('cs_instance', 'retag'): 2,
+}
+
+
+class CloudStackBenchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.results = {}
+
+
+    def run(self):
+        for size in self.options.sizes:
+            simulator = CloudStackSimulator(vms=size, latency=self.options.latency,
+                                            job_duration=self.options.job_duration)
+            server = start_server(simulator, port=0)
+            try:
+                env = os.environ.copy()
+                env['CLOUDSTACK_ENDPOINT'] = 'http://%s:%s/client/api' % server.server_address
+                env['CLOUDSTACK_KEY'] = 'benchmark'
+                env['CLOUDSTACK_SECRET'] = 'benchmark'
+                env['CLOUDSTACK_METHOD'] = 'get'
+                env['CLOUDSTACK_TIMEOUT'] = '60'
+                env['ANSIBLE_LIBRARY'] = LIBRARY_DIR
+                env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+                env['ANSIBLE_RETRY_FILES_ENABLED'] = 'False'
+                for module in self.options.modules:
+                    for step, args in SCENARIOS[module]:
+                        result = self.run_step(simulator, env, module, step, args)
+                        self.results.setdefault(module, {}).setdefault(str(size), {})[step] = result
+                        self.print_result(module, size, step, result)
+            finally:
+                server.shutdown()
+                server.server_close()
+        return self.results
+
+
+    def run_step(self, simulator, env, module, step, args):
+        playbook = [ {
+            'hosts':        'localhost',
+            'connection':   'local',
+            'gather_facts': False,
+            'tasks':        [ { 'name': '%s %s' % (module, step), module: args } ],
+        } ]
+        fd, playbook_file = tempfile.mkstemp(suffix='.yml')
+        f = os.fdopen(fd, 'w')
+        json.dump(playbook, f)
+        f.close()
+
+        simulator.reset_stats()
+        started = time.time()
+        try:
+            process = subprocess.Popen([ self.options.ansible_playbook, '-v', '-i', 'localhost,', playbook_file,
+                                         '-e', 'ansible_python_interpreter=%s' % self.options.python ],
+                                       env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.stdout.read()
+            # wait4 returns the resource usage of this very child (and its waited for children)
+            pid, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            os.unlink(playbook_file)
+        wall_time = time.time() - started
+
+        stats = simulator.stats
+        changed = re.search(r'changed=(\d+)', output)
+        result = {
+            'ok':          os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0,
+            'changed':     bool(changed and int(changed.group(1))),
+            'api_calls':   sum([ s['calls'] for s in stats.values() ]),
+            'list_calls':  sum([ s['calls'] for c, s in stats.items() if c.startswith('list') ]),
+            'connections': simulator.connections,
+            'bytes':       sum([ s['bytes'] for s in stats.values() ]),
+            'poll_time':   round(sum([ float(t) for t in re.findall(r'"poll_time": ([\d.]+)', output) ]), 3),
+            'wall_time':   round(wall_time, 3),
+            'peak_rss':    rusage.ru_maxrss,
+            'commands':    dict((c, s['calls']) for c, s in stats.items()),
+        }
+        if not result['ok']:
+            result['output'] = output
+        return result
+
+
+    def print_result(self, module, size, step, result):
+        print "%-24s %7s %-10s %-7s api=%-4d list=%-4d conn=%-4d bytes=%-10d time=%7.3fs rss=%dkB" % (
+            module, size, step, not result['ok'] and 'FAILED' or result['changed'] and 'changed' or 'ok', result['api_calls'], result['list_calls'],
+            result['connections'], result['bytes'], result['wall_time'], result['peak_rss'])
+        if not result['ok']:
+            print result['output']
+        sys.stdout.flush()
+
+
+    def check(self, baseline):
+        """Return a list of regressions compared to the baseline, if any, and of concurrent jobs awaited one after another."""
+        regressions = []
+        for module, sizes in self.results.iteritems():
+            for size, steps in sizes.iteritems():
+                for step, result in steps.iteritems():
+                    name = "%s/%s/%s" % (module, size, step)
+                    if not result['ok']:
+                        regressions.append("%s: failed" % name)
+                    if step == 'idempotent' and result['changed']:
+                        regressions.append("%s: reported a change" % name)
+
+                    jobs = CONCURRENT_JOBS.get((module, step))
+                    if jobs and self.options.job_duration > 0 and result['poll_time'] >= jobs * self.options.job_duration:
+                        regressions.append("%s: waited %.3fs for %d concurrent jobs of %.3fs" % (name, result['poll_time'],
+                                           jobs, self.options.job_duration))
+
+                    expected = baseline.get(module, {}).get(size, {}).get(step)
+                    if not expected:
+                        continue
+                    for key in [ 'api_calls', 'list_calls' ]:
+                        if result[key] > expected[key]:
+                            regressions.append("%s: %s %d > %d (%s)" % (name, key, result[key], expected[key],
+                                               ', '.join([ '%s=%d' % c for c in sorted(result['commands'].items()) ])))
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CloudStack modules against the local simulator')
+    parser.add_argument('--sizes', default='100,1000', help='comma separated number of VMs in the dataset')
+    parser.add_argument('--modules', default=','.join(sorted(SCENARIOS.keys())))
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--job-duration', type=float, default=0.0)
+    parser.add_argument('--ansible-playbook', default='ansible-playbook')
+    parser.add_argument('--python', default=sys.executable, help='python interpreter running the modules')
+    parser.add_argument('--save', help='write results as new baseline')
+    parser.add_argument('--check', help='compare results to baseline, exit 1 on regressions')
+    parser.add_argument('--json', help='write results to file')
+    options = parser.parse_args()
+    options.sizes = [ int(s) for s in options.sizes.split(',') ]
+    options.modules = options.modules.split(',')
+    for module in options.modules:
+        if module not in SCENARIOS:
+            print >> sys.stderr, "Error: No scenario for module %s." % module
+            sys.exit(1)
+
+    benchmark = CloudStackBenchmark(options)
+    results = benchmark.run()
+
+    if options.json:
+        f = open(options.json, 'w')
+        json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+        f.close()
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+        f.close()
+
+    baseline = {}
+    if options.check:
+        f = open(options.check)
+        baseline = json.load(f)
+        f.close()
+    regressions = benchmark.check(baseline)
+    if regressions:
+        print >> sys.stderr, "Regressions:\n  %s" % '\n  '.join(regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,999 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+######################################################################
+
+"""
+Local CloudStack API simulator.
+===============================
+
+Serves the subset of the CloudStack API used by the cs_* modules and the
+inventory scripts from memory, so they can be run and benchmarked without a
+cloud and without network access. Requests are not authenticated.
+
+  cloudstack_simulator.py --port 8888 --vms 10000 --latency 0.05 --job-duration 1
+
+Point the modules or inventory scripts to it by env vars:
+
+  export CLOUDSTACK_ENDPOINT=http://127.0.0.1:8888/client/api
+  export CLOUDSTACK_KEY=simulator
+  export CLOUDSTACK_SECRET=simulator
+
+Besides the API, the server answers GET /_stats with the number of calls and
+response bytes per API command and resets them on POST /_reset. It speaks
+HTTP/1.1 with keep-alive and counts the TCP connections accepted in
+CloudStackSimulator.connections.
+
+The simulator can also be used in-process:
+
+  simulator = CloudStackSimulator(vms=1000)
+  server = start_server(simulator, port=0)
+  ...
+  server.shutdown()
+
+
+usage: cloudstack_simulator.py [--port PORT] [--vms N] [--projects N]
+                               [--networks N] [--security-groups N]
+                               [--firewall-rules N] [--tags N]
+                               [--latency SECONDS] [--job-duration SECONDS]
+                               [--page-size N] [--seed N]
+"""
+
+import sys
+import time
+import uuid
+import random
+import urlparse
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+try:
+    import json
+except:
+    import simplejson as json
+
+
+class CloudStackSimulatorError(Exception):
+
+    def __init__(self, errortext, errorcode=431):
+        Exception.__init__(self, errortext)
+        self.errortext = errortext
+        self.errorcode = errorcode
+
+
+class CloudStackSimulator(object):
+
+    def __init__(self, vms=100, projects=0, networks=2, security_groups=2, firewall_rules=10,
+                 tags=2, latency=0.0, job_duration=0.0, page_size=500, seed=42):
+        self.latency = latency
+        self.job_duration = job_duration
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.stats = {}
+        self.connections = 0
+        self.jobs = {}
+        self.ids = {}
+        self.store = {}
+        for resource in [ 'zone', 'domain', 'account', 'project', 'ostype', 'serviceoffering',
+                          'diskoffering', 'networkoffering', 'template', 'iso', 'network',
+                          'virtualmachine', 'volume', 'securitygroup', 'publicipaddress',
+                          'firewallrule', 'egressfirewallrule', 'portforwardingrule',
+                          'instancegroup', 'router', 'event' ]:
+            self.store[resource] = []
+        self.populate(vms, projects, networks, security_groups, firewall_rules, tags)
+
+
+    def _id(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+
+    def _now(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%S+0000', time.gmtime())
+
+
+    def _ip(self, subnet, host):
+        return "10.%d.%d.%d" % (subnet, host / 250, host % 250 + 2)
+
+
+    def _mac(self):
+        return "02:00:%02x:%02x:%02x:%02x" % tuple(self.random.randint(0, 255) for i in range(4))
+
+
+    def populate(self, vms, projects, networks, security_groups, firewall_rules, tags):
+        zone = self.add('zone', name='ch-gva-2', networktype='Advanced', allocationstate='Enabled')
+        self.add('zone', name='ch-dk-2', networktype='Advanced', allocationstate='Enabled')
+        domain = self.add('domain', name='ROOT', path='ROOT', level=0)
+        account = self.add('account', name='admin', domain='ROOT', domainid=domain['id'], accounttype=1)
+        self.account = account
+        self.domain = domain
+
+        for i in range(projects):
+            self.add('project', name='project-%d' % i, displaytext='project-%d' % i,
+                     domain='ROOT', domainid=domain['id'], account='admin', state='Active', tags=[])
+
+        self.add('ostype', description='Debian GNU/Linux 7(64-bit)')
+        self.add('ostype', description='Other (64-bit)')
+        tiny = self.add('serviceoffering', name='Tiny', displaytext='Tiny', cpunumber=1, cpuspeed=2198, memory=512)
+        self.add('serviceoffering', name='Small', displaytext='Small', cpunumber=1, cpuspeed=2198, memory=2048)
+        self.add('diskoffering', name='Performance', displaytext='Performance', disksize=20)
+        offering = self.add('networkoffering', name='DefaultIsolatedNetworkOfferingWithSourceNatService',
+                            displaytext='Offering for Isolated networks with Source Nat service enabled',
+                            guestiptype='Isolated', state='Enabled')
+        template = self.add('template', name='Linux Debian 7 64-bit', displaytext='Linux Debian 7 64-bit',
+                            zoneid=zone['id'], zonename=zone['name'], hypervisor='KVM', isready=True,
+                            ostypename='Debian GNU/Linux 7(64-bit)', format='QCOW2', checksum='0b31bccccb048d20b551f70830bb7ad0',
+                            templatetype='USER', account='admin', domain='ROOT', domainid=domain['id'], tags=[])
+        self.add('iso', name='Linux Debian 7 64-bit', displaytext='Linux Debian 7 64-bit',
+                 zoneid=zone['id'], zonename=zone['name'], isready=True, tags=[])
+
+        for i in range(max(networks, 1)):
+            network = self.add('network', name='network-%d' % i, displaytext='network-%d' % i,
+                               zoneid=zone['id'], zonename=zone['name'], networkofferingid=offering['id'],
+                               networkofferingname=offering['name'], state='Implemented', type='Isolated',
+                               cidr='10.%d.0.0/16' % i, netmask='255.255.0.0', gateway='10.%d.0.1' % i,
+                               account='admin', domain='ROOT', domainid=domain['id'], tags=[])
+        # Tags of other resources than VMs show up in the events as well
+        network['tags'].append(self._new_tag(network, 'Network', 'env', 'test'))
+        self._event('CREATE_TAGS', network, 'Network')
+
+        for i in range(max(security_groups, 1)):
+            self.add('securitygroup', name=(i == 0 and 'default' or 'sg-%d' % i),
+                     description='', account='admin', domain='ROOT', domainid=domain['id'],
+                     ingressrule=[], egressrule=[], tags=[])
+
+        ip = self.add('publicipaddress', ipaddress='185.19.28.%d' % 10, zoneid=zone['id'], zonename=zone['name'],
+                      associatednetworkid=self.store['network'][0]['id'], issourcenat=True, isstaticnat=False,
+                      state='Allocated', account='admin', domain='ROOT', domainid=domain['id'], tags=[])
+
+        for i in range(firewall_rules):
+            self.add('firewallrule', ipaddressid=ip['id'], ipaddress=ip['ipaddress'], protocol='tcp',
+                     startport=str(10000 + i), endport=str(10000 + i), cidrlist='0.0.0.0/0', state='Active', tags=[])
+
+        for i in range(vms):
+            # VMs are spread over the account scope and the projects
+            project = None
+            if i % (projects + 1):
+                project = self.store['project'][i % (projects + 1) - 1]
+            vm = self._new_vm('vm-%05d' % i, zone, tiny, template,
+                              self.store['network'][i % len(self.store['network'])],
+                              self.store['securitygroup'][0], project, group='group-%d' % (i % 10))
+            for t in range(tags):
+                vm['tags'].append(self._new_tag(vm, 'UserVm', 'tag-%d' % t, 'value-%d' % (i % 5)))
+
+        for i in range(10):
+            self.add('instancegroup', name='group-%d' % i, account='admin', domain='ROOT', domainid=domain['id'])
+
+        for i, network in enumerate(self.store['network']):
+            self.add('router', name='r-%d-VM' % i, zoneid=zone['id'], zonename=zone['name'], state='Running',
+                     role='VIRTUAL_ROUTER', redundantstate='UNKNOWN', linklocalip='169.254.0.%d' % (i + 2),
+                     serviceofferingname='System Offering For Software Router', account='admin',
+                     domain='ROOT', domainid=domain['id'], networkdomain='cs.internal',
+                     nic=[ { 'id': self._id(), 'ipaddress': network['gateway'], 'macaddress': self._mac(),
+                             'netmask': network['netmask'], 'isdefault': False } ])
+
+
+    def add(self, resource, **record):
+        if 'id' not in record:
+            record['id'] = self._id()
+        if 'created' not in record:
+            record['created'] = self._now()
+        self.store[resource].append(record)
+        # Ids stay known after the resource is removed
+        self.ids.setdefault(resource, set()).add(record['id'])
+        return record
+
+
+    def _new_vm(self, name, zone, offering, template, network, security_group, project=None, group=None, displayname=None):
+        nic = {
+            'id':         self._id(),
+            'networkid':  network['id'],
+            'networkname': network['name'],
+            'ipaddress':  self._ip(self.store['network'].index(network), len(self.store['virtualmachine'])),
+            'macaddress': self._mac(),
+            'netmask':    network['netmask'],
+            'gateway':    network['gateway'],
+            'type':       network['type'],
+            'isdefault':  True,
+            'secondaryip': [],
+        }
+        vm = {
+            'name':                name,
+            'displayname':         displayname or name,
+            'instancename':        'i-2-%d-VM' % len(self.store['virtualmachine']),
+            'account':             'admin',
+            'domain':              'ROOT',
+            'domainid':            self.domain['id'],
+            'zoneid':              zone['id'],
+            'zonename':            zone['name'],
+            'state':               'Running',
+            'hypervisor':          'KVM',
+            'serviceofferingid':   offering['id'],
+            'serviceofferingname': offering['name'],
+            'cpunumber':           offering['cpunumber'],
+            'cpuspeed':            offering['cpuspeed'],
+            'memory':              offering['memory'],
+            'cpuused':             '1%',
+            'templateid':          template['id'],
+            'templatename':        template['name'],
+            'passwordenabled':     False,
+            'securitygroup':       [ { 'id': security_group['id'], 'name': security_group['name'] } ],
+            'affinitygroup':       [],
+            'nic':                 [ nic ],
+            'tags':                [],
+        }
+        if group:
+            vm['group'] = group
+        if project:
+            vm['projectid'] = project['id']
+            vm['project'] = project['name']
+        vm = self.add('virtualmachine', **vm)
+        self.add('volume', name='ROOT-%s' % vm['id'], type='ROOT', virtualmachineid=vm['id'], zoneid=zone['id'])
+        self._event('VM.CREATE', vm)
+        return vm
+
+
+    def _new_tag(self, resource, resource_type, key, value):
+        tag = {
+            'key':          key,
+            'value':        value,
+            'resourceid':   resource['id'],
+            'resourcetype': resource_type,
+            'account':      'admin',
+            'domain':       'ROOT',
+            'domainid':     self.domain['id'],
+        }
+        if 'projectid' in resource:
+            tag['projectid'] = resource['projectid']
+        return tag
+
+
+    def _event(self, event_type, resource, resource_type=None):
+        event = {
+            'id':          self._id(),
+            'type':        event_type,
+            'level':       'INFO',
+            'state':       'Completed',
+            'description': '%s %s' % (event_type, resource['id']),
+            'resourceid':  resource['id'],
+            'account':     'admin',
+            'domain':      'ROOT',
+            'created':     self._now(),
+        }
+        if resource_type:
+            event['resourcetype'] = resource_type
+        if 'projectid' in resource:
+            event['projectid'] = resource['projectid']
+            event['project'] = resource.get('project')
+        self.store['event'].append(event)
+
+
+    def _get(self, resource, id):
+        for record in self.store[resource]:
+            if record['id'] == id:
+                return record
+        raise CloudStackSimulatorError("Unable to find %s with id %s" % (resource, id))
+
+
+    def _find_resource(self, id):
+        for resource, records in self.store.iteritems():
+            for record in records:
+                if record['id'] == id:
+                    return record
+        raise CloudStackSimulatorError("Unable to find resource with id %s" % id)
+
+
+    def _get_list_param(self, params, name):
+        # Turn "tags[0].key=foo&tags[0].value=bar" into [ { 'key': 'foo', 'value': 'bar' } ]
+        items = {}
+        prefix = name + '['
+        for key, value in params.iteritems():
+            if key.startswith(prefix):
+                index, field = key[len(prefix):].split('].', 1)
+                items.setdefault(int(index), {})[field] = value
+        return [ items[i] for i in sorted(items) ]
+
+
+    def _job(self, result_key, record, command):
+        job = {
+            'jobid':         self._id(),
+            'cmd':           command,
+            'created':       self._now(),
+            'done':          time.time() + self.job_duration,
+            'jobresulttype': 'object',
+            'jobresult':     { result_key: record } if result_key else { 'success': True },
+            'userid':        self.account['id'],
+            'accountid':     self.account['id'],
+        }
+        self.jobs[job['jobid']] = job
+        return { 'jobid': job['jobid'], 'id': record.get('id') if record else None }
+
+
+    def _job_status(self, job):
+        res = {
+            'jobid':     job['jobid'],
+            'cmd':       job['cmd'],
+            'created':   job['created'],
+            'userid':    job['userid'],
+            'accountid': job['accountid'],
+        }
+        if time.time() < job['done']:
+            res['jobstatus'] = 0
+            res['jobprocstatus'] = 0
+        else:
+            res['jobstatus'] = 1
+            res['jobresultcode'] = 0
+            res['jobresulttype'] = job['jobresulttype']
+            res['jobresult'] = job['jobresult']
+        return res
+
+
+    def _list(self, records, params, result_key, match_keys=('name',), filters=(), scoped=True):
+        # Like CloudStack, reject ids which are not of a resource of this type
+        known_ids = self.ids.get(result_key)
+        if known_ids is not None:
+            for id in [ params.get('id') ] + params.get('ids', '').split(','):
+                if id and id not in known_ids:
+                    raise CloudStackSimulatorError("Invalid parameter id value=%s due to incorrect long value format, "
+                                                   "or entity does not exist" % id)
+
+        if params.get('id'):
+            records = [ r for r in records if r['id'] == params['id'] ]
+
+        if params.get('ids'):
+            ids = set(params['ids'].split(','))
+            records = [ r for r in records if r['id'] in ids ]
+
+        name = params.get('name')
+        if name and 'name' in match_keys:
+            records = [ r for r in records if name.lower() in r.get('name', '').lower() ]
+
+        keyword = params.get('keyword')
+        if keyword:
+            keyword = keyword.lower()
+            records = [ r for r in records if [ k for k in match_keys if keyword in unicode(r.get(k, '')).lower() ] ]
+
+        # Without projectid only resources of the account scope are listed, -1 lists all project resources
+        project_id = params.get('projectid')
+        if not scoped:
+            pass
+        elif project_id == '-1':
+            records = [ r for r in records if 'projectid' in r ]
+        elif project_id:
+            records = [ r for r in records if r.get('projectid') == project_id ]
+        else:
+            records = [ r for r in records if 'projectid' not in r ]
+
+        for param in filters:
+            value = params.get(param)
+            if value:
+                records = [ r for r in records if unicode(r.get(param, '')).lower() == value.lower() ]
+
+        for tag in self._get_list_param(params, 'tags'):
+            records = [ r for r in records if [ t for t in r.get('tags', []) if t['key'] == tag.get('key') and t['value'] == tag.get('value') ] ]
+
+        count = len(records)
+        if 'page' in params:
+            page = int(params['page'])
+            pagesize = int(params.get('pagesize', 500))
+            records = records[(page - 1) * pagesize:page * pagesize]
+        else:
+            # Like a real server, an unpaginated listing is cut at the default page size
+            records = records[:self.page_size]
+
+        if not records:
+            return {}
+        return { 'count': count, result_key: records }
+
+
+    def handle(self, command, params):
+        handler = getattr(self, 'api_' + command, None)
+        if not handler:
+            raise CloudStackSimulatorError("The given command '%s' does not exist or it is not available for user" % command, 432)
+        with self.lock:
+            return handler(params)
+
+
+    def record_stats(self, command, response_bytes, duration):
+        with self.lock:
+            stats = self.stats.setdefault(command, { 'calls': 0, 'bytes': 0, 'time': 0.0 })
+            stats['calls'] += 1
+            stats['bytes'] += response_bytes
+            stats['time'] = round(stats['time'] + duration, 6)
+
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+            self.connections = 0
+
+
+    # Accounts, domains, zones, offerings and other lookups
+
+    def api_listZones(self, params):
+        return self._list(self.store['zone'], params, 'zone')
+
+
+    def api_listDomains(self, params):
+        return self._list(self.store['domain'], params, 'domain')
+
+
+    def api_listAccounts(self, params):
+        return self._list(self.store['account'], params, 'account')
+
+
+    def api_listProjects(self, params):
+        return self._list(self.store['project'], params, 'project', match_keys=('name', 'displaytext'))
+
+
+    def api_listOsTypes(self, params):
+        return self._list(self.store['ostype'], params, 'ostype', match_keys=('description',))
+
+
+    def api_listHypervisors(self, params):
+        return { 'count': 1, 'hypervisor': [ { 'name': 'KVM' } ] }
+
+
+    def api_listCapabilities(self, params):
+        return { 'capability': { 'cloudstackversion': '4.5.1', 'securitygroupsenabled': True,
+                                 'userpublictemplateenabled': True, 'projectinviterequired': False } }
+
+
+    def api_listServiceOfferings(self, params):
+        return self._list(self.store['serviceoffering'], params, 'serviceoffering')
+
+
+    def api_listDiskOfferings(self, params):
+        return self._list(self.store['diskoffering'], params, 'diskoffering')
+
+
+    def api_listNetworkOfferings(self, params):
+        return self._list(self.store['networkoffering'], params, 'networkoffering')
+
+
+    def api_listVPCs(self, params):
+        return {}
+
+
+    def api_listInstanceGroups(self, params):
+        return self._list(self.store['instancegroup'], params, 'instancegroup')
+
+
+    def api_listRouters(self, params):
+        return self._list(self.store['router'], params, 'router', filters=('state', 'zoneid'))
+
+
+    def api_listEvents(self, params):
+        # Newest first, as listed by CloudStack
+        events = list(reversed(self.store['event']))
+        if params.get('startdate'):
+            startdate = params['startdate'].replace('T', ' ')[:19]
+            events = [ e for e in events if e['created'].replace('T', ' ')[:19] >= startdate ]
+        return self._list(events, params, 'event', match_keys=('type', 'description'), filters=('type',))
+
+
+    def api_listPublicIpAddresses(self, params):
+        return self._list(self.store['publicipaddress'], params, 'publicipaddress', match_keys=('ipaddress',), filters=('ipaddress',))
+
+
+    def api_listVolumes(self, params):
+        return self._list(self.store['volume'], params, 'volume', filters=('virtualmachineid', 'type'))
+
+
+    def api_listSnapshots(self, params):
+        return {}
+
+
+    def api_listNics(self, params):
+        vm = self._get('virtualmachine', params.get('virtualmachineid'))
+        return { 'count': len(vm['nic']), 'nic': vm['nic'] }
+
+
+    # Templates and ISOs
+
+    def api_listTemplates(self, params):
+        return self._list(self.store['template'], params, 'template', match_keys=('name', 'displaytext'), filters=('zoneid',))
+
+
+    def api_listIsos(self, params):
+        return self._list(self.store['iso'], params, 'iso', match_keys=('name', 'displaytext'), filters=('zoneid',))
+
+
+    def api_registerTemplate(self, params):
+        zone = self._get('zone', params['zoneid'])
+        template = self.add('template', name=params['name'], displaytext=params.get('displaytext', params['name']),
+                            zoneid=zone['id'], zonename=zone['name'], hypervisor=params.get('hypervisor', 'KVM'),
+                            format=params.get('format', 'QCOW2'), checksum=params.get('checksum', ''),
+                            isready=False, templatetype='USER', account='admin', domain='ROOT',
+                            domainid=self.domain['id'], tags=[])
+        return { 'count': 1, 'template': [ template ] }
+
+
+    def api_createTemplate(self, params):
+        template = self.add('template', name=params['name'], displaytext=params.get('displaytext', params['name']),
+                            zoneid=self.store['zone'][0]['id'], zonename=self.store['zone'][0]['name'],
+                            hypervisor='KVM', format='QCOW2', checksum='', isready=True, templatetype='USER',
+                            account='admin', domain='ROOT', domainid=self.domain['id'], tags=[])
+        return self._job('template', template, 'createTemplate')
+
+
+    def api_deleteTemplate(self, params):
+        template = self._get('template', params['id'])
+        self.store['template'].remove(template)
+        return self._job(None, None, 'deleteTemplate')
+
+
+    # Virtual machines
+
+    # Keys of a VM returned by listVirtualMachines only if their group is in details
+    vm_details = {
+        'group':   [ 'group', 'groupid' ],
+        'nics':    [ 'nic' ],
+        'secgrp':  [ 'securitygroup' ],
+        'affgrp':  [ 'affinitygroup' ],
+        'servoff': [ 'serviceofferingid', 'serviceofferingname', 'cpunumber', 'cpuspeed', 'memory' ],
+        'tmpl':    [ 'templateid', 'templatename', 'passwordenabled' ],
+        'stats':   [ 'cpuused' ],
+    }
+
+    def api_listVirtualMachines(self, params):
+        res = self._list(self.store['virtualmachine'], params, 'virtualmachine',
+                         match_keys=('name', 'displayname'), filters=('zoneid', 'state', 'groupid'))
+        details = params.get('details', 'all').split(',')
+        if res and 'all' not in details:
+            hidden = [ k for group, keys in self.vm_details.items() if group not in details for k in keys ]
+            res['virtualmachine'] = [ dict((k, v) for k, v in vm.items() if k not in hidden) for vm in res['virtualmachine'] ]
+        return res
+
+
+    def api_deployVirtualMachine(self, params):
+        for vm in self.store['virtualmachine']:
+            if vm['name'] == params.get('name') and vm['state'] != 'Destroyed':
+                raise CloudStackSimulatorError("The vm with hostName %s already exists" % params['name'])
+
+        zone = self._get('zone', params['zoneid'])
+        offering = self._get('serviceoffering', params['serviceofferingid'])
+        template = self._get('template', params['templateid'])
+        network = self.store['network'][0]
+        if params.get('networkids'):
+            network = self._get('network', params['networkids'].split(',')[0])
+        security_group = self.store['securitygroup'][0]
+        project = None
+        if params.get('projectid'):
+            project = self._get('project', params['projectid'])
+
+        name = params.get('name') or 'VM-%s' % self._id()
+        vm = self._new_vm(name, zone, offering, template, network, security_group, project,
+                          group=params.get('group'), displayname=params.get('displayname'))
+        if params.get('keypair'):
+            vm['keypair'] = params['keypair']
+        return self._job('virtualmachine', vm, 'deployVirtualMachine')
+
+
+    def _set_vm_state(self, params, state, command, event_type):
+        vm = self._get('virtualmachine', params['id'])
+        vm['state'] = state
+        self._event(event_type, vm)
+        return self._job('virtualmachine', vm, command)
+
+
+    def api_startVirtualMachine(self, params):
+        return self._set_vm_state(params, 'Running', 'startVirtualMachine', 'VM.START')
+
+
+    def api_stopVirtualMachine(self, params):
+        return self._set_vm_state(params, 'Stopped', 'stopVirtualMachine', 'VM.STOP')
+
+
+    def api_rebootVirtualMachine(self, params):
+        return self._set_vm_state(params, 'Running', 'rebootVirtualMachine', 'VM.REBOOT')
+
+
+    def api_destroyVirtualMachine(self, params):
+        vm = self._get('virtualmachine', params['id'])
+        if params.get('expunge') == 'True':
+            self.store['virtualmachine'].remove(vm)
+            vm['state'] = 'Expunging'
+            self._event('VM.EXPUNGE', vm)
+            return self._job('virtualmachine', vm, 'destroyVirtualMachine')
+        return self._set_vm_state(params, 'Destroyed', 'destroyVirtualMachine', 'VM.DESTROY')
+
+
+    def api_updateVirtualMachine(self, params):
+        vm = self._get('virtualmachine', params['id'])
+        for key in [ 'displayname', 'group' ]:
+            if params.get(key):
+                vm[key] = params[key]
+        self._event('VM.UPDATE', vm)
+        return { 'virtualmachine': vm }
+
+
+    def api_changeServiceForVirtualMachine(self, params):
+        vm = self._get('virtualmachine', params['id'])
+        offering = self._get('serviceoffering', params['serviceofferingid'])
+        vm['serviceofferingid'] = offering['id']
+        vm['serviceofferingname'] = offering['name']
+        vm['cpunumber'] = offering['cpunumber']
+        vm['memory'] = offering['memory']
+        self._event('VM.UPGRADE', vm)
+        return { 'virtualmachine': vm }
+
+
+    def api_resetSSHKeyForVirtualMachine(self, params):
+        vm = self._get('virtualmachine', params['id'])
+        vm['keypair'] = params.get('keypair')
+        return self._job('virtualmachine', vm, 'resetSSHKeyForVirtualMachine')
+
+
+    # Networks
+
+    def api_listNetworks(self, params):
+        return self._list(self.store['network'], params, 'network', match_keys=('name', 'displaytext'), filters=('zoneid',))
+
+
+    def api_createNetwork(self, params):
+        zone = self._get('zone', params['zoneid'])
+        offering = self._get('networkoffering', params['networkofferingid'])
+        i = len(self.store['network'])
+        network = self.add('network', name=params['name'], displaytext=params.get('displaytext', params['name']),
+                           zoneid=zone['id'], zonename=zone['name'], networkofferingid=offering['id'],
+                           networkofferingname=offering['name'], state='Allocated', type='Isolated',
+                           cidr='10.%d.0.0/16' % i, netmask='255.255.0.0', gateway='10.%d.0.1' % i,
+                           networkdomain=params.get('networkdomain'), account='admin', domain='ROOT',
+                           domainid=self.domain['id'], tags=[])
+        return { 'network': network }
+
+
+    def api_updateNetwork(self, params):
+        network = self._get('network', params['id'])
+        for key in [ 'name', 'displaytext', 'networkdomain' ]:
+            if params.get(key):
+                network[key] = params[key]
+        return self._job('network', network, 'updateNetwork')
+
+
+    def api_restartNetwork(self, params):
+        network = self._get('network', params['id'])
+        return self._job('network', network, 'restartNetwork')
+
+
+    def api_deleteNetwork(self, params):
+        network = self._get('network', params['id'])
+        self.store['network'].remove(network)
+        return self._job(None, None, 'deleteNetwork')
+
+
+    # Firewall and port forwarding rules
+
+    def api_listFirewallRules(self, params):
+        return self._list(self.store['firewallrule'], params, 'firewallrule', filters=('ipaddressid',))
+
+
+    def api_listEgressFirewallRules(self, params):
+        return self._list(self.store['egressfirewallrule'], params, 'firewallrule', filters=('networkid',))
+
+
+    def _create_firewall_rule(self, resource, params, command):
+        rule = {
+            'protocol': params.get('protocol', 'tcp'),
+            'cidrlist': params.get('cidrlist', '0.0.0.0/0'),
+            'state':    'Active',
+            'tags':     [],
+        }
+        if 'startport' in params:
+            rule['startport'] = params['startport']
+            rule['endport'] = params.get('endport', params['startport'])
+        if 'icmptype' in params:
+            rule['icmptype'] = int(params['icmptype'])
+            rule['icmpcode'] = int(params.get('icmpcode', -1))
+        if 'ipaddressid' in params:
+            ip = self._get('publicipaddress', params['ipaddressid'])
+            rule['ipaddressid'] = ip['id']
+            rule['ipaddress'] = ip['ipaddress']
+        if 'networkid' in params:
+            rule['networkid'] = params['networkid']
+        rule = self.add(resource, **rule)
+        return self._job('firewallrule', rule, command)
+
+
+    def api_createFirewallRule(self, params):
+        return self._create_firewall_rule('firewallrule', params, 'createFirewallRule')
+
+
+    def api_createEgressFirewallRule(self, params):
+        return self._create_firewall_rule('egressfirewallrule', params, 'createEgressFirewallRule')
+
+
+    def api_deleteFirewallRule(self, params):
+        self.store['firewallrule'].remove(self._get('firewallrule', params['id']))
+        return self._job(None, None, 'deleteFirewallRule')
+
+
+    def api_deleteEgressFirewallRule(self, params):
+        self.store['egressfirewallrule'].remove(self._get('egressfirewallrule', params['id']))
+        return self._job(None, None, 'deleteEgressFirewallRule')
+
+
+    def api_listPortForwardingRules(self, params):
+        return self._list(self.store['portforwardingrule'], params, 'portforwardingrule', filters=('ipaddressid',))
+
+
+    def api_createPortForwardingRule(self, params):
+        ip = self._get('publicipaddress', params['ipaddressid'])
+        vm = self._get('virtualmachine', params['virtualmachineid'])
+        rule = self.add('portforwardingrule',
+                        protocol=params.get('protocol', 'tcp'),
+                        publicport=params['publicport'],
+                        publicendport=params.get('publicendport', params['publicport']),
+                        privateport=params['privateport'],
+                        privateendport=params.get('privateendport', params['privateport']),
+                        ipaddressid=ip['id'], ipaddress=ip['ipaddress'],
+                        virtualmachineid=vm['id'], virtualmachinename=vm['name'],
+                        virtualmachinedisplayname=vm['displayname'],
+                        vmguestip=params.get('vmguestip', vm['nic'][0]['ipaddress']),
+                        state='Active', cidrlist='', tags=[])
+        return self._job('portforwardingrule', rule, 'createPortForwardingRule')
+
+
+    def api_deletePortForwardingRule(self, params):
+        self.store['portforwardingrule'].remove(self._get('portforwardingrule', params['id']))
+        return self._job(None, None, 'deletePortForwardingRule')
+
+
+    # Security groups
+
+    def api_listSecurityGroups(self, params):
+        if params.get('securitygroupname'):
+            params = dict(params, name=None)
+            records = [ sg for sg in self.store['securitygroup'] if sg['name'] == params['securitygroupname'] ]
+            return self._list(records, params, 'securitygroup')
+        return self._list(self.store['securitygroup'], params, 'securitygroup')
+
+
+    def api_createSecurityGroup(self, params):
+        for sg in self.store['securitygroup']:
+            if sg['name'] == params['name']:
+                raise CloudStackSimulatorError("Unable to create security group, a group with name %s already exists." % params['name'])
+        sg = self.add('securitygroup', name=params['name'], description=params.get('description', ''),
+                      account='admin', domain='ROOT', domainid=self.domain['id'],
+                      ingressrule=[], egressrule=[], tags=[])
+        return { 'securitygroup': sg }
+
+
+    def api_deleteSecurityGroup(self, params):
+        for sg in self.store['securitygroup']:
+            if sg['name'] == params.get('name') or sg['id'] == params.get('id'):
+                self.store['securitygroup'].remove(sg)
+                return { 'success': 'true' }
+        raise CloudStackSimulatorError("Unable to find security group")
+
+
+    def _authorize(self, params, rule_key, command):
+        sg = self._get('securitygroup', params['securitygroupid'])
+        rule = {
+            'ruleid':   self._id(),
+            'protocol': params.get('protocol', 'tcp'),
+        }
+        if 'startport' in params:
+            rule['startport'] = int(params['startport'])
+            rule['endport'] = int(params.get('endport', params['startport']))
+        if 'icmptype' in params:
+            rule['icmptype'] = int(params['icmptype'])
+            rule['icmpcode'] = int(params.get('icmpcode', -1))
+        groups = self._get_list_param(params, 'usersecuritygrouplist')
+        if groups:
+            rule['securitygroupname'] = groups[0]['group']
+            rule['account'] = groups[0].get('account', 'admin')
+        else:
+            rule['cidr'] = params.get('cidrlist', '0.0.0.0/0')
+        sg[rule_key].append(rule)
+        result = dict(sg)
+        result[rule_key] = [ rule ]
+        return self._job('securitygroup', result, command)
+
+
+    def _revoke(self, params, rule_key, command):
+        for sg in self.store['securitygroup']:
+            for rule in sg[rule_key]:
+                if rule['ruleid'] == params['id']:
+                    sg[rule_key].remove(rule)
+                    return self._job(None, None, command)
+        raise CloudStackSimulatorError("Unable to find rule with id %s" % params['id'])
+
+
+    def api_authorizeSecurityGroupIngress(self, params):
+        return self._authorize(params, 'ingressrule', 'authorizeSecurityGroupIngress')
+
+
+    def api_authorizeSecurityGroupEgress(self, params):
+        return self._authorize(params, 'egressrule', 'authorizeSecurityGroupEgress')
+
+
+    def api_revokeSecurityGroupIngress(self, params):
+        return self._revoke(params, 'ingressrule', 'revokeSecurityGroupIngress')
+
+
+    def api_revokeSecurityGroupEgress(self, params):
+        return self._revoke(params, 'egressrule', 'revokeSecurityGroupEgress')
+
+
+    # Tags
+
+    def api_listTags(self, params):
+        tags = []
+        for resource, records in self.store.iteritems():
+            for record in records:
+                if 'tags' in record and (not params.get('resourceid') or record['id'] == params['resourceid']):
+                    tags.extend(record['tags'])
+        return self._list(tags, params, 'tag', match_keys=('key', 'value'), filters=('key', 'value', 'resourcetype'), scoped=False)
+
+
+    def api_createTags(self, params):
+        for resource_id in params['resourceids'].split(','):
+            resource = self._find_resource(resource_id)
+            for tag in self._get_list_param(params, 'tags'):
+                if [ t for t in resource['tags'] if t['key'] == tag['key'] ]:
+                    raise CloudStackSimulatorError("tag %s already on UserVm with id %s" % (tag['key'], resource_id))
+                resource['tags'].append(self._new_tag(resource, params['resourcetype'], tag['key'], tag.get('value', '')))
+            self._event('CREATE_TAGS', resource, params['resourcetype'])
+        return self._job(None, None, 'createTags')
+
+
+    def api_deleteTags(self, params):
+        for resource_id in params['resourceids'].split(','):
+            resource = self._find_resource(resource_id)
+            tags = self._get_list_param(params, 'tags')
+            keys = [ t['key'] for t in tags ]
+            resource['tags'] = [ t for t in resource['tags'] if tags and t['key'] not in keys ]
+            self._event('DELETE_TAGS', resource, params['resourcetype'])
+        return self._job(None, None, 'deleteTags')
+
+
+    # Async jobs
+
+    def api_queryAsyncJobResult(self, params):
+        job = self.jobs.get(params.get('jobid'))
+        if not job:
+            raise CloudStackSimulatorError("Unable to find job by id %s" % params.get('jobid'))
+        return self._job_status(job)
+
+
+    def api_listAsyncJobs(self, params):
+        jobs = [ self._job_status(job) for job in sorted(self.jobs.values(), key=lambda j: j['created']) ]
+        if params.get('startdate'):
+            jobs = [ j for j in jobs if j['created'][:10] >= params['startdate'][:10] ]
+        return self._list(jobs, params, 'asyncjobs', match_keys=('cmd',), scoped=False)
+
+
+class CloudStackSimulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep connections alive like a real API server, so clients can reuse them
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.simulator.record_connection()
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _send(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+
+    def _dispatch(self, query):
+        simulator = self.server.simulator
+        params = dict((k, v[-1]) for k, v in urlparse.parse_qs(query, keep_blank_values=True).iteritems())
+        command = params.pop('command', '')
+        started = time.time()
+        if simulator.latency:
+            time.sleep(simulator.latency)
+
+        try:
+            status, data = 200, { command.lower() + 'response': simulator.handle(command, params) }
+        except CloudStackSimulatorError, e:
+            status, data = e.errorcode, { command.lower() + 'response': { 'errorcode': e.errorcode, 'errortext': e.errortext } }
+        except (KeyError, ValueError), e:
+            status, data = 431, { command.lower() + 'response': { 'errorcode': 431, 'errortext': 'Invalid parameter: %s' % e } }
+
+        response_bytes = self._send(status, data)
+        simulator.record_stats(command, response_bytes, time.time() - started)
+
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/_stats':
+            self._send(200, self.server.simulator.stats)
+        else:
+            self._dispatch(url.query)
+
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/_reset':
+            self.server.simulator.reset_stats()
+            self._send(200, {})
+        else:
+            length = int(self.headers.getheader('content-length') or 0)
+            self._dispatch(self.rfile.read(length))
+
+
+class CloudStackSimulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, simulator, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CloudStackSimulatorHandler)
+        self.simulator = simulator
+
+
+def start_server(simulator, host='127.0.0.1', port=8888):
+    """Serve the simulator in a background thread and return the server."""
+    server = CloudStackSimulatorServer(simulator, (host, port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local CloudStack API simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--vms', type=int, default=100)
+    parser.add_argument('--projects', type=int, default=0)
+    parser.add_argument('--networks', type=int, default=2)
+    parser.add_argument('--security-groups', type=int, default=2)
+    parser.add_argument('--firewall-rules', type=int, default=10)
+    parser.add_argument('--tags', type=int, default=2, help='tags per VM')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--job-duration', type=float, default=0.0, help='seconds until an async job finishes')
+    parser.add_argument('--page-size', type=int, default=500, help='server default page size')
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args()
+
+    simulator = CloudStackSimulator(vms=options.vms, projects=options.projects, networks=options.networks,
+                                    security_groups=options.security_groups, firewall_rules=options.firewall_rules,
+                                    tags=options.tags, latency=options.latency, job_duration=options.job_duration,
+                                    page_size=options.page_size, seed=options.seed)
+    server = CloudStackSimulatorServer(simulator, (options.host, options.port))
+    print >> sys.stderr, "CloudStack simulator listening on http://%s:%s/client/api" % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()